@@ -1,28 +1,44 @@
 import plumb as _
+from collections import defaultdict
+import importlib.metadata
+import logging
 from pathlib import Path
 import os
+import pickle
+import stat
 
 from .grammar import parse_commands
 from .world import World
 from .routable import Routable
+from .index import RuleIndex
+from .multigrep import GrepDatabase, grep_patterns, prescan
 from . import ast
 
-import click
+logger = logging.getLogger(__name__)
 
 
-def route_file(world: World, commands: list[ast.Command], file: str | Path) -> World:
+def route_file(
+    world: World,
+    commands: list[ast.Command],
+    file: str | Path,
+    index: RuleIndex | None = None,
+    type: str | None = None,
+) -> World:
     wdir = None  # TODO from command line args.
-    type = None  # TODO from command line args.
     if wdir is None:
         wdir = os.getcwd()
+    stat_cache: dict[str, os.stat_result | None] = {}
     if wdir and type is None:
-        p = Path(wdir).joinpath(file) if isinstance(file, str) else file
-        if p.is_file():
-            type = "file"
-            print(f"{p} is a file!")
-        if p.is_dir():
-            type = "dir"
-            print(f"{p} is a dir!")
+        p = str(Path(wdir).joinpath(file) if isinstance(file, str) else file)
+        try:
+            st = stat_cache[p] = os.stat(p)
+        except OSError:
+            st = stat_cache[p] = None
+        if st is not None:
+            if stat.S_ISREG(st.st_mode):
+                type = "file"
+            elif stat.S_ISDIR(st.st_mode):
+                type = "dir"
     if type is None:
         type = "text"
     msg = Routable(
@@ -33,114 +49,134 @@ def route_file(world: World, commands: list[ast.Command], file: str | Path) -> W
         wdir=Path(wdir),
         type=type,
         attr={},
+        stat_cache=stat_cache,
     )
     world.next_obj(msg)
-    world.route(commands, msg)
+    world.route(commands, msg, index)
     return world
 
 
 def route_command_line_args(
-    ctx, commands: list[ast.Command], args: list[str] | list[Path]
+    ctx,
+    commands: list[ast.Command],
+    args: list[str] | list[Path],
+    index: RuleIndex | None = None,
+    grep_db: GrepDatabase | None = None,
 ) -> World:
     world = World()
     world.dry_run = ctx.obj["dry_run"]
+    world.grep_db = grep_db
+    world.external_grep = ctx.obj.get("external_grep", False)
+    jobs = world.jobs = ctx.obj.get("jobs", 1)
+    if jobs > 1 and len(args) > 1:
+        # Search all the files up front, in parallel, for the greps the rules
+        # could run on them.
+        patterns = grep_patterns(commands)
+        world.prescanned = frozenset(patterns)
+        world.prescans = prescan([Path(a) for a in args], patterns, jobs)
+    types = scan_types(args)
     for arg in args:
-        route_file(world, commands, arg)
+        route_file(world, commands, arg, index, types.get(os.fspath(arg)))
     return world
 
 
+# Fewest arguments sharing a directory for which reading the directory is
+# cheaper than stat'ing each one.
+SCAN_MIN_SIBLINGS = 5
+
+
+def scan_types(args: list[str] | list[Path]) -> dict[str, str]:
+    """
+    Classify args that share a directory with many others from one scandir
+    of that directory, rather than a stat per arg. Args not covered here are
+    left for route_file to stat.
+    """
+    by_dir: defaultdict[str, list[str]] = defaultdict(list)
+    for arg in map(os.fspath, args):
+        by_dir[os.path.dirname(arg)].append(arg)
+
+    types = {}
+    for parent, siblings in by_dir.items():
+        if len(siblings) < SCAN_MIN_SIBLINGS:
+            continue
+        try:
+            with os.scandir(parent or ".") as it:
+                entries = {e.name: e for e in it}
+        except OSError:
+            continue
+        for arg in siblings:
+            if (entry := entries.get(os.path.basename(arg))) is None:
+                continue
+            if entry.is_file():
+                types[arg] = "file"
+            elif entry.is_dir():
+                types[arg] = "dir"
+            else:
+                types[arg] = "text"
+    return types
+
+
+def _rules_cache_key(rules_path: Path) -> tuple:
+    """
+    Changes whenever the rules, or any of plumb's modules, change. The
+    pickled rules hold instances of classes from across the package.
+    """
+    try:
+        version = importlib.metadata.version("plumb")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    modules = sorted(Path(__file__).parent.glob("*.py"))
+    return (version,) + tuple(
+        x
+        for p in (rules_path, *modules)
+        for st in (os.stat(p),)
+        for x in (str(p), st.st_mtime_ns, st.st_size)
+    )
+
+
 def load_rules():
     # TODO: honor XDG_CONFIG_HOME
-    with open(Path.home().joinpath(".config/plumb_rules")) as rulefd:
-        return parse_commands(rulefd.read())
+    rules_path = Path.home().joinpath(".config/plumb_rules")
+    cache_path = Path.home().joinpath(".cache/plumb_rules.pkl")
+    key = _rules_cache_key(rules_path)
+
+    # Parsing is most of plumb's startup time, so reuse the last parse of an
+    # unchanged rules file.
+    try:
+        with open(cache_path, "rb") as cachefd:
+            cached_key, rules = pickle.load(cachefd)
+        if cached_key == key:
+            return rules
+    except Exception:
+        pass
+
+    with open(rules_path) as rulefd:
+        rules = parse_commands(rulefd.read())
+
+    # The cache is only an optimization. Failing to write it, for whatever
+    # reason, mustn't fail loading the rules (in watch mode that would kill
+    # the thread reloading them).
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "wb") as cachefd:
+            pickle.dump((key, rules), cachefd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        logger.exception("Not caching the parsed rules")
+        tmp_path.unlink(missing_ok=True)
+    return rules
 
 
 def main():
     import sys
 
-    rules = load_rules()
-    w = route_command_line_args(None, rules, sys.argv[1:])
-    w.run()
-
+    logging.basicConfig()
 
-@click.group(invoke_without_command=True)
-@click.option("--dryrun", type=bool, default=False)
-@click.pass_context
-def cli(ctx: click.Context, dryrun: bool):
-    ctx.ensure_object(dict)
-    ctx.obj["dry_run"] = dryrun
-    if ctx.invoked_subcommand is None:
-        ctx.invoke(file)
-
-
-@cli.command()
-@click.option("--verbose", type=bool, default=False)
-def check(verbose):
-    rules = load_rules()
-    if verbose:
-        import pprint
-
-        pprint.pprint(rules)
-
-
-@cli.command()
-@click.argument("files", nargs=-1, type=click.Path())
-@click.option("--wdir", type=str, default=None)
-@click.pass_context
-def file(ctx, files, wdir):
     rules = load_rules()
-    w = route_command_line_args(ctx, rules, files)
+    w = route_command_line_args(None, rules, sys.argv[1:])
     w.run()
 
 
-@cli.command()
-@click.argument("target", nargs=1, type=click.Path())
-@click.pass_context
-def watch(ctx, target):
-    rules = load_rules()
-    # on rule file updates: load rules
-    # on target dir subtree modification, route new paths
-    # TODO decide what to do with removed paths
-    from watchdog.observers import Observer
-    from watchdog.events import FileSystemEventHandler
-    import watchdog.events
-
-    observer = Observer()
-
-    class RuleUpdater(FileSystemEventHandler):
-        def on_any_event(self, _: watchdog.events.FileSystemEvent):
-            nonlocal rules
-            rules = load_rules()
-
-    config = Path.home().joinpath(".config/plumb_rules")
-    observer.schedule(RuleUpdater(), str(config))
-
-    class Router(FileSystemEventHandler):
-        # on_any_event
-        # on_created
-        # on_deleted
-        # on_modifiedent
-        # on_moved
-        def on_created(self, event: watchdog.events.FileCreatedEvent):
-            world = World()
-            world.dry_run = ctx.obj["dry_run"]
-            world = route_file(world, rules, event.src_path)
-            world.run()
-
-        def on_moved(self, event: watchdog.events.FileMovedEvent):
-            world = World()
-            world = route_file(world, rules, event.dest_path)
-            world.run()
-
-    observer.schedule(Router(), target, recursive=True)
-    observer.start()
-    try:
-        while observer.is_alive():
-            observer.join(1)
-    finally:
-        observer.stop()
-        observer.join()
-
-
 if __name__ == "__main__":
     main()
@@ -1,7 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Protocol
+from typing import Callable, ClassVar, Protocol
 import typing
 
 from .util import optstr, optpath
@@ -19,25 +19,49 @@ class Action(Protocol):
     A thing that modifies the World to make itself happen using the value.
     """
 
+    __slots__ = ()
+
     def run(self, world: "World", value: Routable) -> None:
         ...
 
 
 class Expr:
+    __slots__ = ()
+
     def eval(self, world: "World", value: Routable) -> Value:
         ...
 
+    def const_value(self) -> Value:
+        """
+        What eval always returns, if that's known without a world or value.
+        """
+        return None
 
+
+@dataclass(slots=True)
 class Condition:
     """
     A thing that checks the world or value for validity.
     """
 
-    datasource: Expr | None = None
+    datasource: Expr | None = field(
+        default=None, kw_only=True, repr=False, compare=False
+    )
+
+    # Rough relative expense of check(), used to run cheap conditions first.
+    COST: ClassVar[int] = 10
+    # Whether check() leaves the world alone, so it may be reordered.
+    PURE: ClassVar[bool] = True
+
+    def cost(self) -> int:
+        return self.COST
+
+    def pure(self) -> bool:
+        return self.PURE
 
     def get_str_data(self, world: "World", value: Routable) -> str | None:
         if self.datasource is None:
-            return optstr(value.data)
+            return value.data_str
         else:
             return optstr(self.datasource.eval(world, value))
 
@@ -50,6 +74,13 @@ class Condition:
     def check(self, world: "World", value: Routable) -> bool:
         ...
 
+    def compile(self) -> Callable[["World", Routable], bool]:
+        """
+        Specialize this condition into a single function equivalent to check.
+        Only call once the condition tree is completely built.
+        """
+        return self.check
+
 
 class CommandResult(Enum):
     NEXT_COMMAND = None
@@ -58,5 +89,7 @@ class CommandResult(Enum):
 
 
 class Command(Protocol):
+    __slots__ = ()
+
     def run(self, world: "World", value: Routable) -> CommandResult:
         ...
@@ -1,24 +1,20 @@
 from dataclasses import dataclass, field
-from fnmatch import fnmatchcase
+import fnmatch
+import functools
 import stat
 import re
-from typing import Any, Generator, Optional
+from typing import Any, Callable, Optional
 import os
 
-import logging
-
-logger = logging.getLogger()
-logging.basicConfig()
-
 from .world import World
 from .routable import Routable
-from .util import optstr
+from .util import optstr, optpath
 
 
 from .aast import Command, CommandResult, Expr, Condition, Action, Value
 
 
-@dataclass
+@dataclass(slots=True)
 class RuleCommand(Command):
     """
     A stanza of conditions and actions to run if the conditions are true.
@@ -30,7 +26,7 @@ class RuleCommand(Command):
         return CommandResult.NEXT_COMMAND
 
 
-@dataclass
+@dataclass(slots=True)
 class VariableReference(Expr):
     var: str
 
@@ -38,21 +34,41 @@ class VariableReference(Expr):
         return world.var(self.var, None)
 
 
-@dataclass
+@dataclass(slots=True)
 class ExprLiteral(Expr):
     val: str
 
     def eval(self, world: World, value: Routable) -> Value:
         return self.val
 
+    def const_value(self) -> Value:
+        return self.val
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(pattern: str | bytes, flags: int = 0) -> re.Pattern:
+    """
+    Compile match patterns: those only known at routing time, and constant
+    ones repeated across rules.
+    """
+    return re.compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_grep(pattern: bytes) -> re.Pattern:
+    """
+    Compile grep patterns. Kept apart from _compile, so templated greps over
+    many files don't lose their patterns to churn from match conditions.
+    """
+    return re.compile(pattern, re.MULTILINE)
+
 
-def as_constant(ex: Expr):
-    if isinstance(ex, ExprLiteral):
-        return ex.val
-    return None
+@functools.lru_cache(maxsize=1024)
+def _compile_glob(pattern: str) -> re.Pattern:
+    return re.compile(fnmatch.translate(pattern))
 
 
-@dataclass
+@dataclass(slots=True)
 class SetVariable(Action, Command):
     var: str
     rhs: Expr
@@ -69,24 +85,24 @@ class SetVariable(Action, Command):
         world.set_var(self.var, optstr(self.rhs.eval(world, value)))
 
 
-@dataclass
+@dataclass(slots=True)
 class CopyToAction(Action, Command):
     destination: Expr
 
     def run(self, world: World, value: Routable) -> CommandResult:
-        src: str | None = optstr(value.data)
+        src: str | None = value.data_str
         dst = optstr(self.destination.eval(world, value))
         if src is not None and dst is not None:
             world.add_rsync(dst, [src])
         return CommandResult.NEXT_COMMAND
 
 
-@dataclass
+@dataclass(slots=True)
 class MoveToAction(Action, Command):
     destination: Expr
 
     def run(self, world: World, value: Routable) -> CommandResult:
-        src: str | None = optstr(value.data)
+        src: str | None = value.data_str
         dst = optstr(self.destination.eval(world, value))
         if src is not None and dst is not None:
             world.add_move(dst=dst, src=src)
@@ -94,83 +110,265 @@ class MoveToAction(Action, Command):
         return CommandResult.NEXT_COMMAND
 
 
-@dataclass
+@dataclass(slots=True)
 class StopAction(Action):
     def run(self, world: World, value: Routable) -> CommandResult:
         return CommandResult.STOP
 
 
-@dataclass
+Predicate = Callable[[World, Routable], bool]
+
+
+def _cheapest_first(conditions: tuple[Condition, ...]) -> list[Condition]:
+    """
+    Sort conditions by cost, without moving any across one with side effects.
+    """
+    ordered: list[Condition] = []
+    run: list[Condition] = []
+    for c in conditions:
+        if c.pure():
+            run.append(c)
+        else:
+            ordered.extend(sorted(run, key=Condition.cost))
+            ordered.append(c)
+            run.clear()
+    ordered.extend(sorted(run, key=Condition.cost))
+    return ordered
+
+
+@dataclass(slots=True)
 class ConditionCommand(Command):
     condition: Condition
 
+    _predicate: Predicate = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # The parser only wraps a condition in a command once its tree is
+        # finished, so it can be compiled now. Nothing is cached on the
+        # command at run time: parsed rules are shared and pickled.
+        self._predicate = self.condition.compile()
+
+    def __reduce__(self):
+        # The predicate is a closure, which can't be pickled. Rebuild it.
+        return (ConditionCommand, (self.condition,))
+
     def run(self, world: World, value: Routable) -> CommandResult:
-        if self.condition.check(world, value):
+        if self._predicate(world, value):
             return CommandResult.NEXT_COMMAND
         return CommandResult.NEXT_RULE
 
 
-@dataclass
+@dataclass(slots=True)
 class AndCondition(Condition):
     children: tuple[Condition, ...]
 
+    # The children's bound check methods.
+    _checks: tuple[Predicate, ...] = field(
+        init=False, default=(), repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        # a and (b and c) is just a and b and c.
+        self.children = tuple(
+            g
+            for c in self.children
+            for g in (
+                c.children
+                if isinstance(c, AndCondition) and c.datasource is None
+                else (c,)
+            )
+        )
+        self._checks = tuple(c.check for c in self.children)
+
     def check(self, world: World, value: Routable) -> bool:
-        return all(c.check(world, value) for c in self.children)
+        for c in self._checks:
+            if not c(world, value):
+                return False
+        return True
+
+    def cost(self) -> int:
+        return sum(c.cost() for c in self.children)
+
+    def pure(self) -> bool:
+        return all(c.pure() for c in self.children)
+
+    def compile(self) -> Predicate:
+        # Cheap conditions first, so expensive ones only run on likely matches.
+        checks = tuple(c.compile() for c in _cheapest_first(self.children))
+
+        def check(world: World, value: Routable) -> bool:
+            for c in checks:
+                if not c(world, value):
+                    return False
+            return True
 
+        return check
 
-@dataclass
+
+@dataclass(slots=True)
 class OrCondition(Condition):
     children: tuple[Condition, ...]
 
+    # The children's bound check methods.
+    _checks: tuple[Predicate, ...] = field(
+        init=False, default=(), repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        # a or (b or c) is just a or b or c.
+        self.children = tuple(
+            g
+            for c in self.children
+            for g in (
+                c.children
+                if isinstance(c, OrCondition) and c.datasource is None
+                else (c,)
+            )
+        )
+        self._checks = tuple(c.check for c in self.children)
+
     def check(self, world: World, value: Routable) -> bool:
-        return any(c.check(world, value) for c in self.children)
+        for c in self._checks:
+            if c(world, value):
+                return True
+        return False
+
+    def cost(self) -> int:
+        return sum(c.cost() for c in self.children)
 
+    def pure(self) -> bool:
+        return all(c.pure() for c in self.children)
 
-@dataclass
+    def compile(self) -> Predicate:
+        # Cheap conditions first, so expensive ones only run when nothing
+        # cheaper already matched.
+        checks = tuple(c.compile() for c in _cheapest_first(self.children))
+
+        def check(world: World, value: Routable) -> bool:
+            for c in checks:
+                if c(world, value):
+                    return True
+            return False
+
+        return check
+
+
+@dataclass(slots=True)
 class NotCondition(Condition):
     child: Condition
 
     def check(self, world: World, value: Routable) -> bool:
         return not self.child.check(world, value)
 
+    def cost(self) -> int:
+        return self.child.cost()
+
+    def pure(self) -> bool:
+        return self.child.pure()
 
-@dataclass
+    def compile(self) -> Predicate:
+        child = self.child.compile()
+        return lambda world, value: not child(world, value)
+
+
+@dataclass(slots=True)
 class GlobCondition(Condition):
     pattern: Expr
 
+    COST = 1
+
+    _compiled: Optional[re.Pattern] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        if (c := self.pattern.const_value()) is not None:
+            self._compiled = _compile_glob(c)
+
     def check(self, world: World, value: Routable) -> bool:
         dat = self.get_str_data(world, value)
-        pat = optstr(self.pattern.eval(world, value))
-        return dat is not None and pat is not None and fnmatchcase(dat, pat)
+        if dat is None:
+            return False
+        regex = self._compiled
+        if regex is None:
+            pat = optstr(self.pattern.eval(world, value))
+            if pat is None:
+                return False
+            regex = _compile_glob(pat)
+        return regex.match(dat) is not None
+
+    def compile(self) -> Predicate:
+        if self._compiled is None or self.datasource is not None:
+            return self.check
+        match = self._compiled.match
+
+        def check(world: World, value: Routable) -> bool:
+            data = value.data_str
+            return data is not None and match(data) is not None
+
+        return check
 
 
-@dataclass
+@functools.cache
+def _group_names(groups: int) -> tuple[str, ...]:
+    """
+    The variable names for a match's numbered groups: "1", "2", ....
+    """
+    return tuple(str(i) for i in range(1, groups + 1))
+
+
+@dataclass(slots=True)
 class RegexCondition(Condition):
     pattern: Expr
 
+    COST = 5
+    # Sets the match group variables.
+    PURE = False
+
+    _compiled: Optional[re.Pattern] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        if (c := self.pattern.const_value()) is not None:
+            self._compiled = _compile(c)
+
     def check(self, world: World, value: Routable) -> bool:
         dat = self.get_str_data(world, value)
         if dat is None:
             return False
-        pat = optstr(self.pattern.eval(world, value))
-        if pat is None:
-            return False
-        regex = re.compile(pat)
+        regex = self._compiled
+        if regex is None:
+            pat = optstr(self.pattern.eval(world, value))
+            if pat is None:
+                return False
+            regex = _compile(pat)
         if m := regex.match(dat):
-            world.set_var("0", m.group(0))
-            for i, g in enumerate(m.groups()):
-                world.set_var(str(i + 1), g)
-            for k, g in m.groupdict().items():
-                world.set_var(k, g)
+            set_var = world.set_var
+            set_var("0", m.group(0))
+            for k, g in zip(_group_names(regex.groups), m.groups()):
+                set_var(k, g)
+            if regex.groupindex:
+                for k, g in m.groupdict().items():
+                    set_var(k, g)
             return True
         return False
 
 
-@dataclass
+def _notsupported(mode: int) -> bool:
+    return False
+
+
+def _never(world: World, value: Routable) -> bool:
+    return False
+
+
+@dataclass(slots=True)
 class StatFileTypeCondition(Condition):
     filetype: str
 
-    _notsupported = lambda _: False
+    COST = 10
+
     MODE_TYPES = {
         "dir": stat.S_ISDIR,
         "chardev": stat.S_ISCHR,
@@ -185,18 +383,33 @@ class StatFileTypeCondition(Condition):
         "whiteout": getattr(stat, "S_ISWHT", _notsupported),
     }
 
+    _is_x: Any = field(init=False, default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._is_x = self.MODE_TYPES.get(self.filetype, _notsupported)
+
     def check(self, world: World, value: Routable) -> bool:
-        dat = self.get_path_data(world, value)
-        pathname = world.var("file", dat)
+        if self._is_x is _notsupported:
+            # Nothing on this platform can be this type. Don't bother stat'ing.
+            return False
+        if self.datasource is None:
+            pathname = value.resolved_path
+            if pathname is None:
+                pathname = value.resolved_path = optstr(
+                    world.var("file", optpath(value.data))
+                )
+        else:
+            pathname = world.var("file", self.get_path_data(world, value))
         st = world.stat_path(pathname)
         if st is None:
             return False
-        if is_x := self.MODE_TYPES.get(self.filetype):
-            return is_x(st.st_mode)
-        return False
+        return self._is_x(st.st_mode)
 
+    def compile(self) -> Predicate:
+        return _never if self._is_x is _notsupported else self.check
 
-@dataclass
+
+@dataclass(slots=True)
 class InspectAction(Action):
     arg: Any
 
@@ -217,24 +430,41 @@ class InspectAction(Action):
         return CommandResult.NEXT_COMMAND
 
 
-import weakref
 from pathlib import Path
 
-
-greps: weakref.WeakSet["GrepCondition"] = weakref.WeakSet()
+# Characters that make a grep pattern more than a fixed string.
+_REGEX_SYNTAX = frozenset(".^$*+?{}[]\\|()")
 
 
-@dataclass
+@dataclass(slots=True)
 class GrepCondition(Condition):
     condition_args: ...
     pattern: Expr
 
+    COST = 1000
+
     from_offset: Optional[int] = field(init=False, default=None)
     to_offset: Optional[int] = field(init=False, default=None)
 
+    _compiled: Optional[re.Pattern] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+    # The pattern as a fixed string, if it has no regex syntax in it.
+    _literal: Optional[bytes] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+    # World.greps key for the compiled pattern.
+    _key: Optional[tuple[re.Pattern, Optional[int], Optional[int]]] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+
     def __post_init__(self):
-        greps.add(self)
         self.from_offset, self.to_offset = self._range()
+        if (c := self.pattern.const_value()) is not None:
+            self._compiled = _compile_grep(c.encode())
+            self._key = (self._compiled, self.from_offset, self.to_offset)
+            if c and not _REGEX_SYNTAX.intersection(c):
+                self._literal = c.encode()
 
     def _range(self):
         low = None
@@ -252,173 +482,108 @@ class GrepCondition(Condition):
                         low = x[1]
         return (low, high)
 
-    def __hash__(self):
-        return id(self)
-
-    def _matcher(self, p: re.Pattern) -> Generator[tuple[bool, bool], bytes, None]:
-        seen_bytes = 0
-        try:
-            hit = False
-            done = False
-            while True:
-                done = self.to_offset is None or bool(seen_bytes > self.to_offset)
-                line = yield hit, done
-
-                if self.from_offset is not None:
-                    if (
-                        self.from_offset < seen_bytes
-                        and seen_bytes + len(line) < self.from_offset
-                    ):
-                        # Partial offset into this chunk. Skip a bit into it.
-                        inset = self.from_offset - seen_bytes
-                        line = line[inset:]
-                        seen_bytes += inset
-                        print("INSET")
-
-                if (self.from_offset is None or seen_bytes <= self.from_offset) and (
-                    self.to_offset is None or self.to_offset > seen_bytes
-                ):
-                    end = (
-                        -1
-                        if self.to_offset is None
-                        else 1 + self.to_offset - seen_bytes
-                    )
-                    seen_bytes += len(line)
-                    # Avoid searching past to_offset
-                    if end >= 0 and len(line) > end:
-                        line = line[:end]
-                    match = p.search(line)
-                    hit = bool(match)
-        except GeneratorExit:
-            pass
-
-    def _check_all(self, world: World, dat: Path) -> Generator[bool, bytes, None]:
-        """
-        Arange to run all registered greps over the target, so we only have to
-        read each input file once, regardless of the number of greps.
-        """
-        regexen: dict[GrepCondition, Generator[tuple[bool, bool], bytes, None]] = {}
-        for g in greps:
-            if (c := as_constant(g.pattern)) is not None:
-                if dat not in world.greps[g]:
-                    p = re.compile(c.encode())
-                    m = regexen[g] = g._matcher(p)
-                    next(m)
-
-        misses = set()
-        try:
-            while True:
-                line = yield bool(len(regexen))
-                decided = set()
-                for g, p in regexen.items():
-                    matched, done = p.send(line)
-                    if matched:
-                        # matched the target.
-                        world.greps[g][dat] = True
-                        decided.add(g)
-                    elif done:
-                        # out of byte range.
-                        misses.add(g)
-                        world.greps[g][dat] = False
-                        decided.add(g)
-                for g in decided:
-                    del regexen[g]
-        except GeneratorExit:
-            # End of file. Mark all pending greps as not found
-            for g in list(regexen.keys()) + list(misses):
-                if g in world.greps:  # can hit this during system teardown
-                    if dat not in world.greps[g]:
-                        world.greps[g][dat] = False
+    def _whole_file(self) -> bool:
+        return self.from_offset is None and self.to_offset is None
+
+    def _use_external_grep(self, world: World, dat: Path) -> bool:
+        return (
+            world.external_grep
+            and self._literal is not None
+            and self._whole_file()
+            # Already mapped for another grep. Searching that is cheaper.
+            and dat not in world.reads
+        )
 
     def check(self, world: World, value: Routable) -> bool:
-        pat = optstr(self.pattern.eval(world, value))
-        if pat is None:
-            return False
+        regex = self._compiled
+        key = self._key
+        if regex is None or key is None:
+            pat = optstr(self.pattern.eval(world, value))
+            if pat is None:
+                return False
+            regex = _compile_grep(pat.encode())
+            key = (regex, self.from_offset, self.to_offset)
 
         dat = self.get_path_data(world, value)
-        if dat:
-            # If we've already processed this grep for this file, use the cached result.
-            if dat in world.greps[self]:
-                return world.greps[self][dat]
-
-            matcher = None
-            if as_constant(self.pattern) is None:
-                # constant patterns are handled by check all. nonconstants are handled here.
-                matcher = self._matcher(re.compile(pat.encode()))
-                next(matcher)
-
-            if dat in world.reads:
-                # If we have a read in progress for this path, resume it.
-                fh, chk = world.reads[dat]
-            else:
-                # Otherwise, set up to run all greps in parallel over this file.
-                chk = self._check_all(world, dat)
-                next(chk)  # run initialization code
-                fh = open(dat, "rb")
-                trace = world.var("debugtrace", False)
-                if trace:
-                    print("OPEN", dat)
-
-            # TODO: find / write a regex over stream to avoid arbitrarily
-            # breaking binary files at newlines without also reading multi GB files into ram.
-            # https://github.com/nitely/regexy, maybe?
-            for line in fh:
-                if matcher is not None:
-                    matched, done = matcher.send(line)
-                    if matched:
-                        world.greps[self][dat] = True
-                    if matched or done:
-                        matcher = None
-                if chk is not None:
-                    if not chk.send(line):
-                        chk.close()
-                        chk = None
-                if matcher is None and chk is None:
-                    # Both this dynamic pattern and all static patterns are found.
-                    fh.close()
-                    if dat in world.reads:
-                        del world.reads[dat]
-                    break
-
-                if dat in world.greps[self]:
-                    # Hit for this grep (either in chk for static patterns or
-                    # matcher for dynamic patterns). Save state to resume if
-                    # other greps are consulted, but early exit for now.
-                    if chk is not None:
-                        world.reads[dat] = (fh, chk)
-                        chk = None
-                    break
-            else:
-                # We finished the file. Mark that we didn't find a match for
-                # this grep (because no early exit) AND we didn't find a match for any other pending
-                # greps (by closing chk)
-                if matcher is not None:
-                    world.greps[self][dat] = False
-                fh.close()
-                if chk is not None:
-                    chk.close()
-                if dat in world.reads:
-                    del world.reads[dat]
-
-            return world.greps[self][dat]
-
-        return False
-
+        if not dat:
+            return False
 
-@dataclass
+        # Every grep for the same pattern over the same part of this file
+        # shares one search, whichever rule it's in.
+        if (results := world.greps.get(key)) is None:
+            results = world.greps[key] = {}
+        elif (hit := results.get(dat)) is not None:
+            return hit
+
+        hit = None
+        if self._whole_file():
+            hit = world.scan_file(regex.pattern, dat)
+        if hit is None and self._use_external_grep(world, dat):
+            assert self._literal is not None
+            hit = world.grep_file(self._literal, dat)
+        if hit is None:
+            buf = world.read_file(dat)
+            start = self.from_offset or 0
+            end = len(buf) if self.to_offset is None else self.to_offset
+            hit = regex.search(buf, start, end) is not None
+        results[dat] = hit
+        return hit
+
+
+@dataclass(slots=True)
 class EnvironmentLookupExpr(Expr):
     name: Expr
 
+    _name: Optional[str] = field(init=False, default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if (c := self.name.const_value()) is not None:
+            self._name = optstr(c)
+
     def eval(self, world: World, value: Routable) -> Value:
-        name = self.name.eval(world, value)
-        if (strname := optstr(name)) is not None:
+        strname = self._name
+        if strname is None:
+            strname = optstr(self.name.eval(world, value))
+        if strname is not None:
             return os.getenv(strname)
         return None
 
 
-@dataclass
+@dataclass(slots=True)
 class StringConcatExpr(Expr):
     parts: list[Expr]
 
+    # The literal parts pre-joined into a str.format template with a {} for
+    # each dynamic part.
+    _template: str = field(init=False, default="", repr=False, compare=False)
+    _dynamic: tuple[Expr, ...] = field(
+        init=False, default=(), repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        template = []
+        dynamic = []
+        for p in self.parts:
+            if (c := p.const_value()) is not None:
+                template.append(c.replace("{", "{{").replace("}", "}}"))
+            else:
+                template.append("{}")
+                dynamic.append(p)
+        self._template = "".join(template)
+        self._dynamic = tuple(dynamic)
+        if not dynamic:
+            self._template = self._template.format()
+
+    def const_value(self) -> Value:
+        return None if self._dynamic else self._template
+
     def eval(self, world: World, value: Routable) -> Value:
-        return "".join(optstr(p.eval(world, value)) or "" for p in self.parts)
+        match self._dynamic:
+            case ():
+                return self._template
+            case (p,):
+                # "{$dir}/archive" and the like.
+                return self._template.format(optstr(p.eval(world, value)) or "")
+        return self._template.format(
+            *[optstr(p.eval(world, value)) or "" for p in self._dynamic]
+        )
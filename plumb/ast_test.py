@@ -0,0 +1,207 @@
+import os
+import pytest
+from pathlib import Path
+
+from .grammar import parse_commands
+from .routable import Routable
+from .world import World
+from . import ast, multigrep
+
+
+def routed(data: str) -> tuple[World, Routable]:
+    value = Routable(
+        src="",
+        dst="",
+        data=data,
+        original_data=data,
+        type="text",
+        wdir=Path("/nonexistent"),
+        attr={},
+    )
+    world = World()
+    world.next_obj(value)
+    return world, value
+
+
+def test_compiled_condition_matches_check():
+    (cmd,) = parse_commands(
+        """(glob *.py or glob *.txt) and not glob test_* and not is dir"""
+    )
+    assert isinstance(cmd, ast.ConditionCommand)
+    predicate = cmd.condition.compile()
+    for data in ("a.py", "b.txt", "test_a.py", "c.rs"):
+        world, value = routed(data)
+        assert predicate(world, value) == cmd.condition.check(world, value), data
+
+
+def test_nested_junctions_flatten():
+    a, b, c = (ast.GlobCondition(ast.ExprLiteral(p)) for p in "abc")
+    assert ast.AndCondition((a, ast.AndCondition((b, c)))).children == (a, b, c)
+    assert ast.OrCondition((ast.OrCondition((a, b)), c)).children == (a, b, c)
+    mixed = ast.AndCondition((a, ast.OrCondition((b, c))))
+    assert mixed.children == (a, ast.OrCondition((b, c)))
+
+
+def test_compiled_and_runs_cheap_conditions_first():
+    (cmd,) = parse_commands("""grep "x" and glob *.py""")
+    world, value = routed("missing.txt")
+    # The glob fails before the grep tries to open the nonexistent file.
+    assert not cmd.condition.compile()(world, value)
+
+
+def test_string_concat_template():
+    world, value = routed("x")
+    world.set_var("foo", "F")
+    concat = ast.StringConcatExpr(
+        [ast.ExprLiteral("{a}"), ast.VariableReference("foo"), ast.ExprLiteral("}")]
+    )
+    assert concat.eval(world, value) == "{a}F}"
+    constant = ast.StringConcatExpr([ast.ExprLiteral("{"), ast.ExprLiteral("b")])
+    assert constant.eval(world, value) == "{b"
+
+
+def test_identical_greps_share_one_search(tmp_path):
+    target = tmp_path / "target"
+    target.write_bytes(b"first\nsecond line\n")
+    world, value = routed(str(target))
+    a, b, c = (
+        ast.GrepCondition(None, ast.ExprLiteral(p))
+        for p in ("^second", "^second", "^line")
+    )
+    assert a.check(world, value)
+    assert b.check(world, value)
+    assert not c.check(world, value)
+    assert len(world.greps) == 2
+    assert len(world.reads) == 1
+
+
+def test_external_grep_for_fixed_strings(tmp_path):
+    target = tmp_path / "target"
+    target.write_bytes(b"first\nsecond line\n")
+    world, value = routed(str(target))
+    world.external_grep = True
+    hit, miss, regex = (
+        ast.GrepCondition(None, ast.ExprLiteral(p))
+        for p in ("second line", "third", "^second")
+    )
+    assert hit._literal == b"second line"
+    assert regex._literal is None
+    assert hit.check(world, value)
+    assert not miss.check(world, value)
+    assert not world.reads
+    assert regex.check(world, value)
+    assert len(world.reads) == 1
+
+
+def test_grep_patterns_collects_constant_whole_file_greps():
+    commands = parse_commands(
+        """
+rule a
+grep "x" or not grep "y"
+grep(< 10 kb) "z"
+grep "{$data}"
+rule b
+grep "x"
+"""
+    )
+    assert multigrep.grep_patterns(commands) == [b"x", b"y"]
+
+
+def test_compiled_or_runs_cheap_conditions_first():
+    (cmd,) = parse_commands("""grep "x" or glob *.py""")
+    world, value = routed("missing.py")
+    # The glob matches before the grep tries to open the nonexistent file.
+    assert cmd.condition.compile()(world, value)
+
+
+def test_regex_sets_group_variables():
+    world, value = routed("photos/2023/beach.jpg")
+    cond = ast.RegexCondition(ast.ExprLiteral(r"(\w+)/(?P<year>\d+)/(.*)"))
+    assert cond.check(world, value)
+    assert world.var("0", None) == "photos/2023/beach.jpg"
+    assert [world.var(k, None) for k in "123"] == ["photos", "2023", "beach.jpg"]
+    assert world.var("year", None) == "2023"
+
+
+def test_grep_uses_prescan(tmp_path):
+    target = tmp_path / "target"
+    target.write_bytes(b"first\n")
+    world, value = routed(str(target))
+    world.prescanned = frozenset([b"^first", b"second"])
+    world.prescans = multigrep.prescan([target], sorted(world.prescanned), 2)
+    assert world.prescans == {target: frozenset([b"^first"])}
+    first, second = (
+        ast.GrepCondition(None, ast.ExprLiteral(p)) for p in ("^first", "second")
+    )
+    assert first.check(world, value)
+    assert not second.check(world, value)
+    assert not world.reads
+
+
+def test_constant_string_concat_is_constant():
+    concat = ast.StringConcatExpr([ast.ExprLiteral("a"), ast.ExprLiteral("b")])
+    assert ast.GrepCondition(None, concat)._literal == b"ab"
+    dynamic = ast.StringConcatExpr([ast.VariableReference("x")])
+    assert dynamic.const_value() is None
+
+
+def test_grep_database_scans_fixed_strings(tmp_path, monkeypatch):
+    pytest.importorskip("ahocorasick")
+    monkeypatch.setattr(multigrep, "hyperscan", None)
+    monkeypatch.setattr(multigrep.GrepDatabase, "AHOCORASICK_MIN", 2)
+    monkeypatch.setattr(multigrep.GrepDatabase, "SCAN_CHUNK", 4)
+    target = tmp_path / "target"
+    target.write_bytes(b"a sugarcane game\n")
+    world, value = routed(str(target))
+    world.grep_db = multigrep.GrepDatabase([b"sugarcane", b"twine", b"^a"])
+    assert world.grep_db.covers(b"sugarcane")
+    assert not world.grep_db.covers(b"^a")
+    assert world.scan_file(b"sugarcane", target)
+    assert not world.scan_file(b"twine", target)
+    assert world.scan_file(b"^a", target) is None
+
+
+def test_few_fixed_strings_search_on_their_own(monkeypatch):
+    pytest.importorskip("ahocorasick")
+    monkeypatch.setattr(multigrep, "hyperscan", None)
+    assert not multigrep.GrepDatabase([b"the", b"zebra"]).covers(b"the")
+
+
+def test_hyperscan_agrees_with_re(tmp_path):
+    pytest.importorskip("hyperscan")
+    target = tmp_path / "target"
+    patterns = [b"sugarcane", b"twine", b"(?i)twine", b"^Twine", b"game$", b"^a"]
+    patterns += [b"story\\nend", b"zebra", b"e.e", b"^end\\$$", b"^game"]
+    patterns += [b"[a-c]+ [^ ]+e{1,2}", b"\\bgame\\b|x*", b"(?:st)+ory"]
+    # re and PCRE read these differently, so they're left to re.
+    differ = [b"a{,5}c", b"[[:alpha:]]"]
+    target.write_bytes(b"a sugarcane game\nTwine story\nend$\naaac\n")
+    world, value = routed(str(target))
+    world.grep_db = multigrep.GrepDatabase(patterns + differ)
+    for p in patterns + differ:
+        assert world.grep_db.covers(p) is (p not in differ), p
+        expected = bool(ast._compile_grep(p).search(target.read_bytes()))
+        assert world.scan_file(p, target) in (expected, None), p
+
+
+def test_routed_rules_reload_from_cache(tmp_path, monkeypatch):
+    from .__main__ import load_rules, route_file
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    rules_path = tmp_path / ".config/plumb_rules"
+    rules_path.parent.mkdir()
+    rules_path.write_text("rule r\nglob *.txt or glob *.md\nx = y\n")
+    rules = load_rules()
+    world = route_file(World(), rules, "a.txt", type="text")
+    assert world.vars["x"] == "y"
+
+    # Same text, new mtime: parse_commands hands back the routed rules.
+    os.utime(rules_path, ns=(0, 0))
+    assert load_rules() is rules
+    assert (tmp_path / ".cache/plumb_rules.pkl").exists()
+    assert not list((tmp_path / ".cache").glob("plumb_rules.pkl.*"))
+
+    cached = load_rules()
+    assert cached == rules
+    world = route_file(World(), cached, "b.md", type="text")
+    assert world.vars["x"] == "y"
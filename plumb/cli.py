@@ -0,0 +1,134 @@
+import logging
+from pathlib import Path
+
+import click
+
+from .__main__ import load_rules, route_command_line_args, route_file
+from .index import RuleIndex
+from .multigrep import GrepDatabase
+from .world import World
+
+
+@click.group(invoke_without_command=True)
+@click.option("--dryrun", type=bool, default=False)
+@click.option("--external-grep", type=bool, default=False)
+@click.option("--jobs", type=int, default=1)
+@click.pass_context
+def cli(ctx: click.Context, dryrun: bool, external_grep: bool, jobs: int):
+    logging.basicConfig()
+    ctx.ensure_object(dict)
+    ctx.obj["dry_run"] = dryrun
+    ctx.obj["external_grep"] = external_grep
+    ctx.obj["jobs"] = jobs
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(file)
+
+
+@cli.command()
+@click.option("--verbose", type=bool, default=False)
+def check(verbose):
+    rules = load_rules()
+    if verbose:
+        import pprint
+
+        pprint.pprint(rules)
+
+
+@cli.command()
+@click.argument("files", nargs=-1, type=click.Path())
+@click.option("--wdir", type=str, default=None)
+@click.pass_context
+def file(ctx, files, wdir):
+    rules = load_rules()
+    w = route_command_line_args(
+        ctx, rules, files, RuleIndex(rules), GrepDatabase.for_commands(rules)
+    )
+    w.run()
+
+
+def _load_rule_set() -> tuple[list, RuleIndex, GrepDatabase]:
+    rules = load_rules()
+    return rules, RuleIndex(rules), GrepDatabase.for_commands(rules)
+
+
+@cli.command()
+@click.argument("target", nargs=1, type=click.Path())
+@click.pass_context
+def watch(ctx, target):
+    # The rules with their index and grep database, as built together.
+    # Replaced as a whole, so a flush never pairs new rules with an old index.
+    loaded = _load_rule_set()
+    # on rule file updates: load rules
+    # on target dir subtree modification, route new paths
+    # TODO decide what to do with removed paths
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    import watchdog.events
+    import threading
+
+    observer = Observer()
+
+    class RuleUpdater(FileSystemEventHandler):
+        def on_any_event(self, _: watchdog.events.FileSystemEvent):
+            nonlocal loaded
+            loaded = _load_rule_set()
+
+    config = Path.home().joinpath(".config/plumb_rules")
+    observer.schedule(RuleUpdater(), str(config))
+
+    class Router(FileSystemEventHandler):
+        # on_any_event
+        # on_created
+        # on_deleted
+        # on_modifiedent
+        # on_moved
+
+        # How long to wait for more events before routing a batch. Bulk copies
+        # into the target then cost one routing pass rather than one per file.
+        DEBOUNCE_SECONDS = 0.05
+
+        def __init__(self):
+            super().__init__()
+            self._lock = threading.Lock()
+            # Held for a whole flush. Batches route one at a time, since they
+            # share the RuleIndex and its memo of the last data looked up.
+            self._flushing = threading.Lock()
+            self._pending: list[str] = []
+            self._timer: threading.Timer | None = None
+
+        def _enqueue(self, path: str):
+            with self._lock:
+                self._pending.append(path)
+                if self._timer is None:
+                    self._timer = threading.Timer(self.DEBOUNCE_SECONDS, self._flush)
+                    self._timer.start()
+
+        def _flush(self):
+            with self._flushing:
+                with self._lock:
+                    paths, self._pending = self._pending, []
+                    self._timer = None
+                rules, index, grep_db = loaded
+                world = World()
+                world.dry_run = ctx.obj["dry_run"]
+                world.external_grep = ctx.obj["external_grep"]
+                world.jobs = ctx.obj["jobs"]
+                world.grep_db = grep_db
+                for path in paths:
+                    route_file(world, rules, path, index)
+                world.run()
+
+        def on_created(self, event: watchdog.events.FileCreatedEvent):
+            self._enqueue(event.src_path)
+
+        def on_moved(self, event: watchdog.events.FileMovedEvent):
+            self._enqueue(event.dest_path)
+
+    observer.schedule(Router(), target, recursive=True)
+    observer.start()
+    try:
+        while observer.is_alive():
+            observer.join(1)
+    finally:
+        observer.stop()
+        observer.join()
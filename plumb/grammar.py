@@ -1,20 +1,38 @@
-import logging
+import dataclasses
+import functools
+from pathlib import Path
+import re
+import sys
 import lark
 from . import ast
-from typing import Type
+from typing import Hashable, Type
 
-lark.logger.setLevel(logging.DEBUG)
 
 __all__ = ["command_parser"]
 
 FILE_MODE_TYPES = sorted(ast.StatFileTypeCondition.MODE_TYPES.keys())
+# Defined here rather than in the grammar text, which is a raw string.
 FILE_MODE_GRAMMAR = f"""
-%override FILEMODETYPES: {'|'.join(f'"{t}"' for t in FILE_MODE_TYPES)}
+FILEMODETYPES: {'|'.join(f'"{t}"' for t in FILE_MODE_TYPES)}
 """
 
 
-command_parser = lark.Lark(
-    grammar := r"""\
+def _parser_cache() -> str | bool:
+    """
+    Where lark keeps the analyzed parser tables: next to the rules cache, so
+    they survive reboots, or lark's temp file if that's not writable. Lark
+    checks the file against the grammar and options before using it.
+    """
+    try:
+        cache_dir = Path.home().joinpath(".cache")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except (OSError, RuntimeError):  # RuntimeError: no home directory.
+        return True
+    return str(cache_dir.joinpath("plumb_grammar.lark"))
+
+
+grammar = (
+    r"""\
 start: _NL* _command ( _NL+ _command)* _NL*
 
 _command: rulecommand | _actioncommand | _varcommand | conditioncommand
@@ -25,12 +43,13 @@ _varcommand: _varexpr
 _actioncommand: stop | copyto | inspect | moveto
 
 _conditionexpr: notcondition | _atomiccondition | junctioncondition
-junctioncondition: _conditionexpr BOOLEANOPERATION _conditionexpr
+junctioncondition: _conditionexpr (AND | OR) _conditionexpr
 
-BOOLEANOPERATION: "and"|"or"
+AND: "and"i
+OR: "or"i
 
 notcondition: _NOT _atomiccondition
-_NOT.1: "not"i
+_NOT: "not"i
 
 _atomiccondition: ( "(" _conditionexpr ")") | condition
 
@@ -84,39 +103,97 @@ ESCAPED_CHAR: /\\./
 
 _glob_pat: expr
 
-// BAREWORD: non-whitespace text that isn't also keyword-like or things that might
-// be failed attempts at quoting.
-BAREWORD: /(?!\b(and|or|not|glob|is|rule)\b)[^\s#$"'\\\s()={}]+/i
+// BAREWORD: non-whitespace text that isn't also things that might be failed
+// attempts at quoting. Barewords spelled like a keyword lex as that keyword
+// (lark retypes string terminals that BAREWORD would also match whole).
+BAREWORD: /[^\s#$"'\\\s()={}]+/i
 
 // WS_STRING: /[^\s\n]+/
 // EMPTY_LINE: /^\s*\n/
 
 _separated{x, sep}: x (sep x)*
 
-FILEMODETYPES: "dir" | "file"
-
 %import common.NEWLINE -> _NL
-%import common (WS_INLINE, ESCAPED_STRING, SH_COMMENT)
+%import common (WS_INLINE, SH_COMMENT)
 %ignore WS_INLINE
 %ignore SH_COMMENT
 
 """
-    + FILE_MODE_GRAMMAR,
-    debug=True,
-    parser="lalr",
+    + FILE_MODE_GRAMMAR
 )
 
 
+@functools.cache
+def _command_parser() -> lark.Lark:
+    """
+    The parser, built on first use so importing plumb.grammar doesn't touch
+    the file system, and loading cached rules never needs it.
+    """
+    return lark.Lark(
+        grammar,
+        parser="lalr",
+        # Keeps the analyzed LALR tables on disk, so short-lived invocations
+        # skip rebuilding them.
+        cache=_parser_cache(),
+    )
+
+
+def __getattr__(name: str):
+    if name == "command_parser":
+        return _command_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _word(token: lark.Token) -> str:
+    """
+    A token's text as a plain, interned str. Tokens compare with a Python
+    level __eq__, which makes them slow as the names World.var dispatches
+    on and as dict keys.
+    """
+    return sys.intern(str(token))
+
+
+@functools.cache
+def _init_fields(cls: type) -> tuple[str, ...]:
+    return tuple(f.name for f in dataclasses.fields(cls) if f.init)
+
+
+def _structure(node, known: dict[int, Hashable]) -> Hashable:
+    """
+    A key that's equal for structurally identical AST nodes. known holds the
+    keys of nodes already worked out, by id, so shared subtrees aren't walked
+    again for every parent.
+    """
+    if (key := known.get(id(node))) is not None:
+        return key
+    cls = type(node)
+    if dataclasses.is_dataclass(cls):
+        return (cls, *(_structure(getattr(node, n), known) for n in _init_fields(cls)))
+    if isinstance(node, (list, tuple)):
+        return (cls, *(_structure(n, known) for n in node))
+    return node
+
+
 @lark.v_args(inline=True)
 class CommandTree(lark.Transformer):
     def __init__(self):
         super().__init__()
-        self.referenced_variables = set()
+        # One instance of each distinct finished condition, shared by every
+        # rule that uses it.
+        self._conditions: dict[Hashable, ast.Condition] = {}
+        # The keys of the conditions in _conditions, by id. They're kept alive
+        # by _conditions, so the ids can't be reused.
+        self._keys: dict[int, Hashable] = {}
+
+    def _intern(self, condition: ast.Condition) -> ast.Condition:
+        key = _structure(condition, self._keys)
+        condition = self._conditions.setdefault(key, condition)
+        self._keys[id(condition)] = key
+        return condition
 
     def _as_tuple(self, *a) -> tuple:
         return a
 
-    actions = _as_tuple
     condition_modifier = _as_tuple
     condition_arg = _as_tuple
 
@@ -141,11 +218,8 @@ class CommandTree(lark.Transformer):
             case _:
                 raise ValueError("Unknown integer scale {scale!r}")
 
-    def escaped_string(self, value: str) -> str:
-        return value[1:-1].replace(r"\"", '"')
-
     def rulecommand(self, label):
-        return ast.RuleCommand(label)
+        return ast.RuleCommand(_word(label))
 
     def junctioncondition(
         self, lhs: ast.Condition, op: lark.Token, rhs: ast.Condition | None = None
@@ -160,43 +234,18 @@ class CommandTree(lark.Transformer):
             case "or":
                 node = ast.OrCondition
 
-        # Peephole optimization: collapse operator chains to one operator tree
-        # node.
-        match lhs, rhs:
-            case node(lhschildren), node(rhschildren):
-                # (a and b) and (c and d)
-                assert isinstance(lhs, node)
-                lhs.children = lhschildren + rhschildren
-                return lhs
-            case node(lhschildren), _:
-                # (a and b) and c
-                assert isinstance(lhs, node)
-                lhs.children = lhschildren + (rhs,)
-                return lhs
-            case _, node(rhschildren):
-                # c and (a and b)
-                # and also the second most common case of chaining: a and b and c
-                # because the grammar is right recursive.
-                assert isinstance(rhs, node)
-                rhs.children = (lhs,) + rhschildren
-                return rhs
-            case None, None:
-                # dunno how we got here
-                return node(tuple())
-            case _, None:
-                # dunno how we got here
-                return node((lhs,))
-            case None, _:
-                # dunno how we got here
-                return node((rhs,))
-            case _:
-                # The most common case: a and b
-                return node((lhs, rhs))
+        # Operator chains like a and b and c collapse to one tree node as the
+        # node is built, so it's never modified in place after construction.
+        # (A missing operand only happens on odd parses.)
+        return self._intern(node(tuple(c for c in (lhs, rhs) if c is not None)))
 
     junctionconditionnl = junctioncondition
 
     def notcondition(self, child):
-        return ast.NotCondition(child)
+        if isinstance(child, ast.NotCondition) and child.datasource is None:
+            # not (not x) is just x.
+            return child.child
+        return self._intern(ast.NotCondition(child))
 
     def copyto(self, dest):
         return ast.CopyToAction(dest)
@@ -205,9 +254,7 @@ class CommandTree(lark.Transformer):
         if len(pats) == 1:
             return ast.GlobCondition(pats[0])
 
-        globs: list[ast.Condition] = []
-        globs.extend(ast.GlobCondition(p) for p in pats)
-        return ast.OrCondition(tuple(globs))
+        return ast.OrCondition(tuple([ast.GlobCondition(p) for p in pats]))
 
     def stop(self):
         return ast.StopAction()
@@ -217,17 +264,16 @@ class CommandTree(lark.Transformer):
 
     def is_filemodetype(self, filetype):
         assert str(filetype) in ast.StatFileTypeCondition.MODE_TYPES, filetype
-        return ast.StatFileTypeCondition(filetype)
+        return ast.StatFileTypeCondition(_word(filetype))
 
     def setvar(self, var, rhs):
-        return ast.SetVariable(var, rhs)
+        return ast.SetVariable(_word(var), rhs)
 
     def exprliteral(self, value):
-        return ast.ExprLiteral(value)
+        return ast.ExprLiteral(_word(value))
 
     def varref(self, var: lark.Token):
-        self.referenced_variables.add(var)
-        return ast.VariableReference(var)
+        return ast.VariableReference(_word(var))
 
     def conditioncommand(self, condition: ast.Condition):
         return ast.ConditionCommand(condition)
@@ -235,8 +281,9 @@ class CommandTree(lark.Transformer):
     def condition(
         self, datasource: ast.Expr | None, condition: ast.Condition
     ) -> ast.Condition:
+        # Only set on the freshly built condition, before it can be shared.
         condition.datasource = datasource
-        return condition
+        return self._intern(condition)
 
     def match(self, regex: ast.Expr) -> ast.Condition:
         return ast.RegexCondition(regex)
@@ -261,28 +308,27 @@ class CommandTree(lark.Transformer):
         return char[1]
 
     def fstr(self, *parts):
+        # Fuse each run of literal text into one ExprLiteral.
         fused: list[ast.Expr] = []
+        run: list[str] = []
         for part in parts:
             match part:
-                # Flatten the string bits
-                case ast.ExprLiteral(v) | lark.Token("FEXPR_STRING_CHAR", v):
-                    if fused:
-                        if isinstance(fused[-1], ast.ExprLiteral):
-                            fused[-1].val += v
-                            continue
-                        if isinstance(fused[-1], lark.Token):
-                            last: lark.Token = fused[-1]
-                            fused[-1] = ast.ExprLiteral(last + v)
-                        else:
-                            fused.append(ast.ExprLiteral(v))
-                    else:
-                        fused.append(ast.ExprLiteral(v))
+                case ast.ExprLiteral(v):
+                    run.append(v)
+                case str():
+                    # FEXPR_STRING_CHAR tokens and escaped characters.
+                    run.append(part)
                 case ast.Expr():
+                    if run:
+                        fused.append(ast.ExprLiteral("".join(run)))
+                        run.clear()
                     fused.append(part)
                 case _:
                     assert (
                         False
                     ), f"Unexpected element in string or regex literal: {part!r}"
+        if run:
+            fused.append(ast.ExprLiteral("".join(run)))
 
         match len(fused):
             case 1:
@@ -297,7 +343,70 @@ class CommandTree(lark.Transformer):
     regex = fstr
 
 
+# Lines that are a whole "stop" or "rule <name>" command, and nothing else.
+# These don't need the parser. Names follow the grammar's BAREWORD. The \r is
+# the rest of a \r\n line break.
+_TRIVIAL_LINE = re.compile(
+    r"[ \t]*(?:(?P<stop>stop)|rule[ \t]+(?P<label>[^\s#$\"'\\()={}]+))[ \t]*\r?",
+    re.IGNORECASE,
+)
+
+
+def _trivial_command(line: str) -> ast.Command | None:
+    if (m := _TRIVIAL_LINE.fullmatch(line)) is None:
+        return None
+    if m["stop"] is not None:
+        return ast.StopAction()
+    return ast.RuleCommand(sys.intern(m["label"]))
+
+
+def _is_blank(line: str) -> bool:
+    line = line.lstrip(" \t")
+    return not line or line == "\r" or line.startswith("#")
+
+
+@functools.lru_cache(maxsize=128)
 def parse_commands(text, grammarentrypoint="start") -> list[ast.Command]:
-    p = command_parser.parse(text, start=grammarentrypoint)
+    """
+    Parse text into commands. Memoized, since watch mode reloads the rules on
+    every touch of the file whether or not its text changed, so the result is
+    shared between callers and must not be modified. (It's a tuple.)
+
+    Every command is on a line of its own, so the lines that are just "stop"
+    or "rule <name>" are built directly, and only the rest go through lark.
+    """
+    if grammarentrypoint != "start" or text.endswith("\r"):
+        # A \r that isn't part of a line break is an error lark reports.
+        return _parse(text, grammarentrypoint)
+
+    lines = text.split("\n")
+    # The directly built commands, or None for each line lark makes one of.
+    slots: list[ast.Command | None] = []
+    for i, line in enumerate(lines):
+        if _is_blank(line):
+            continue
+        cmd = _trivial_command(line)
+        if cmd is not None:
+            # Blanked rather than dropped, so lark's errors keep their line
+            # numbers.
+            lines[i] = ""
+        slots.append(cmd)
+
+    if None not in slots:
+        if not slots:
+            # No commands at all. Let lark report that.
+            return _parse(text)
+        return tuple(slots)
+
+    parsed = _parse("\n".join(lines))
+    if len(parsed) != slots.count(None):
+        # Some line wasn't one command after all. Do it the slow way.
+        return _parse(text)
+    rest = iter(parsed)
+    return tuple(next(rest) if cmd is None else cmd for cmd in slots)
+
+
+def _parse(text: str, grammarentrypoint: str = "start") -> list[ast.Command]:
+    p = _command_parser().parse(text, start=grammarentrypoint)
     commands: list[ast.Command] = CommandTree().transform(p)
     return commands
@@ -1,6 +1,8 @@
 from .grammar import parse_commands
 from . import ast
+import lark
 from lark import Token
+import pytest
 
 
 def bareword(s: str) -> Token:
@@ -588,7 +590,7 @@ def test_fstring_strcat_substring_prefix():
     assert r[0].rhs == ast.ExprLiteral("foobar")
 
 
-def test_fstring_strcat_substring_prefix():
+def test_fstring_strcat_substring_suffix():
     r = parse_commands(
         """
     x = "foo{"bar"}"
@@ -651,3 +653,73 @@ def test_fstring_strcat_varref_infix():
             ast.ExprLiteral("a"),
         ]
     )
+
+
+def test_identical_conditions_are_shared():
+    r = parse_commands(
+        """
+        rule a
+        is file and glob *.txt
+        rule b
+        is file
+        $dst is file
+        """
+    )
+    a = r[1].condition
+    assert isinstance(a, ast.AndCondition)
+    assert a.children[0] is r[3].condition
+    assert r[4].condition is not r[3].condition
+
+
+def test_keyword_prefixed_barewords():
+    r = parse_commands(
+        """
+        notes = x
+        glob android* AND not glob ornament
+        """
+    )
+    assert r[0] == ast.SetVariable(word("notes"), litword("x"))
+    assert r[1].condition == ast.AndCondition(
+        (
+            ast.GlobCondition(litword("android*")),
+            ast.NotCondition(ast.GlobCondition(litword("ornament"))),
+        )
+    )
+
+
+def test_parse_commands_is_memoized():
+    text = "rule memo\nglob *.memo\n"
+    assert parse_commands(text) is parse_commands(text)
+
+
+def test_names_are_plain_strings():
+    setvar, cond = parse_commands(
+        """
+        x = $data
+        is file
+        """
+    )
+    assert type(setvar.var) is str
+    assert type(setvar.rhs.var) is str
+    assert type(cond.condition.filetype) is str
+
+
+def test_double_negation_cancels():
+    (r,) = parse_commands("not (not glob *.py)")
+    assert r.condition == ast.GlobCondition(litword("*.py"))
+
+
+def test_trivial_lines_skip_the_parser():
+    r = parse_commands("RULE one\r\n  stop  \r\n# c\nglob *.py\nrule two # c\n")
+    assert r == (
+        ast.RuleCommand(word("one")),
+        ast.StopAction(),
+        ast.ConditionCommand(ast.GlobCondition(litword("*.py"))),
+        ast.RuleCommand(word("two")),
+    )
+
+
+def test_trivial_lines_keep_error_line_numbers():
+    with pytest.raises(lark.UnexpectedInput) as e:
+        parse_commands("rule x\nstop\nglob (\n")
+    assert e.value.line == 3
@@ -0,0 +1,140 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from typing import Iterable
+
+from . import ast
+from .aast import Command
+
+# Characters that end a run of literal text in a glob pattern. "]" is included
+# so that suffix scans don't mistake the inside of a [...] set for a literal.
+_WILDCARDS = frozenset("*?[]")
+
+
+def _literal_prefix(pattern: str) -> str:
+    for i, c in enumerate(pattern):
+        if c in _WILDCARDS:
+            return pattern[:i]
+    return pattern
+
+
+def _literal_suffix(pattern: str) -> str:
+    for i in range(len(pattern) - 1, -1, -1):
+        if pattern[i] in _WILDCARDS:
+            return pattern[i + 1 :]
+    return pattern
+
+
+def _guard_patterns(cmd: Command) -> tuple[str, ...] | None:
+    """
+    The constant glob patterns of a condition command that only globs the
+    message data, or None if the command does anything else.
+    """
+    if not isinstance(cmd, ast.ConditionCommand):
+        return None
+    cond = cmd.condition
+    if cond.datasource is not None:
+        return None
+    conds = cond.children if isinstance(cond, ast.OrCondition) else (cond,)
+    patterns = []
+    for c in conds:
+        if not isinstance(c, ast.GlobCondition) or c.datasource is not None:
+            return None
+        if (p := c.pattern.const_value()) is None:
+            return None
+        patterns.append(str(p))
+    return tuple(patterns) or None
+
+
+@dataclass(slots=True)
+class _Node:
+    children: dict[str, "_Node"] = field(default_factory=dict)
+    # Guard entries whose literal directory prefix ends at this node.
+    entries: set[int] = field(default_factory=set)
+
+
+class RuleIndex:
+    """
+    Prefilter for rules that open with a constant glob of the message data.
+
+    Each guard pattern is filed under its literal leading directories (in a
+    segment trie) and its literal extension, so the rules that could possibly
+    match some data are found without trying every pattern. Surviving
+    candidates are confirmed with fnmatchcase. Rules that don't start with
+    such a glob are never skipped.
+    """
+
+    def __init__(self, commands: Iterable[Command]):
+        commands = list(commands)
+        # Positions of the rule commands that have a guard glob.
+        self._guarded: set[int] = set()
+        # (rule command position, pattern)
+        self._entries: list[tuple[int, str]] = []
+        self._root = _Node()
+        self._by_ext: defaultdict[str, set[int]] = defaultdict(set)
+        self._any_ext: set[int] = set()
+
+        for pos, cmd in enumerate(commands[:-1]):
+            if not isinstance(cmd, ast.RuleCommand):
+                continue
+            patterns = _guard_patterns(commands[pos + 1])
+            if patterns is None:
+                continue
+            self._guarded.add(pos)
+            for pattern in patterns:
+                self._add(pos, pattern)
+
+        self._last_data: str | None = None
+        self._last_candidates: set[int] = set()
+
+    def _add(self, pos: int, pattern: str) -> None:
+        entry = len(self._entries)
+        self._entries.append((pos, pattern))
+
+        node = self._root
+        for segment in _literal_prefix(pattern).split("/")[:-1]:
+            node = node.children.setdefault(segment, _Node())
+        node.entries.add(entry)
+
+        suffix = _literal_suffix(pattern)
+        if "." in suffix:
+            self._by_ext[suffix.rpartition(".")[2]].add(entry)
+        else:
+            self._any_ext.add(entry)
+
+    def candidates(self, data: str) -> set[int]:
+        """
+        Positions of the indexed rules whose guard glob matches data.
+        """
+        node = self._root
+        found = set(node.entries)
+        for segment in data.split("/")[:-1]:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            found |= node.entries
+
+        if "." in data:
+            found &= self._any_ext | self._by_ext.get(data.rpartition(".")[2], set())
+        else:
+            found &= self._any_ext
+
+        return {
+            pos
+            for pos, pattern in (self._entries[e] for e in found)
+            if fnmatchcase(data, pattern)
+        }
+
+    def may_match(self, pos: int, data: str | None) -> bool:
+        """
+        False if the rule at command position pos is known to fail its guard
+        glob for data.
+        """
+        if pos not in self._guarded:
+            return True
+        if data is None:
+            return False
+        if data != self._last_data:
+            self._last_candidates = self.candidates(data)
+            self._last_data = data
+        return pos in self._last_candidates
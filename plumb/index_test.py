@@ -0,0 +1,55 @@
+from .grammar import parse_commands
+from .index import RuleIndex
+
+
+RULES = parse_commands(
+    """
+    rule html
+    glob */Downloads/*.html
+    stop
+
+    rule pictures
+    glob "/home/me/Pictures/*.jpg" "/home/me/Pictures/*.png"
+    stop
+
+    rule tarballs
+    glob *.tar.gz
+    stop
+
+    rule untyped
+    glob "/srv/*"
+    stop
+
+    rule unindexed
+    is file
+    stop
+    """
+)
+
+
+def positions(*labels: str) -> set[int]:
+    return {i for i, c in enumerate(RULES) if getattr(c, "label", None) in set(labels)}
+
+
+def test_candidates_by_extension():
+    index = RuleIndex(RULES)
+    assert index.candidates("/home/me/Downloads/game.html") == positions("html")
+    assert index.candidates("x.tar.gz") == positions("tarballs")
+    assert index.candidates("x.gz") == set()
+
+
+def test_candidates_by_prefix():
+    index = RuleIndex(RULES)
+    assert index.candidates("/home/me/Pictures/a.png") == positions("pictures")
+    assert index.candidates("/home/you/Pictures/a.png") == set()
+    assert index.candidates("/srv/a/b") == positions("untyped")
+
+
+def test_may_match_unindexed_rules():
+    index = RuleIndex(RULES)
+    (unindexed,) = positions("unindexed")
+    (html,) = positions("html")
+    assert index.may_match(unindexed, "anything")
+    assert index.may_match(unindexed, None)
+    assert not index.may_match(html, "anything")
+    assert not index.may_match(html, None)
@@ -0,0 +1,221 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import mmap
+import re
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from . import ast
+from .aast import Command, Condition
+
+try:
+    import hyperscan
+except ImportError:  # Optional. Without it every grep searches on its own.
+    hyperscan = None
+
+try:
+    import ahocorasick
+except ImportError:  # Optional. Only used for fixed strings, without hyperscan.
+    ahocorasick = None
+
+logger = logging.getLogger(__name__)
+
+# The regex syntax that means the same to re and hyperscan. Hyperscan parses
+# PCRE syntax, which differs from re's in places: re reads a{,5} as a repeat
+# that PCRE takes literally, and [[:alpha:]] is a POSIX class only to PCRE.
+# Only patterns made entirely of these tokens are given to hyperscan.
+_ESCAPE = rb"\\(?:[^0-9A-Za-z]|[dDwWsSntr])"
+_HYPERSCAN_TOKEN = b"|".join(
+    [
+        rb"[^\\.^$*+?{}\[\]|()]",  # literal
+        _ESCAPE,
+        rb"\\[bB]",
+        rb"[.^$|)]",
+        rb"\((?:\?:|(?!\?))",  # no other (?...) groups
+        # Quantifiers. Lazy ones match wherever greedy ones do.
+        rb"[*+?]\??",
+        rb"\{[0-9]+(?:,[0-9]*)?\}\??",
+        # Sets, without nested "[" (POSIX classes) or a leading "]".
+        rb"\[\^?(?:[^\\\[\]]|" + _ESCAPE + rb")+\]",
+    ]
+)
+_HYPERSCAN_SAFE = re.compile(rb"(?:\(\?i\))?(?:" + _HYPERSCAN_TOKEN + rb")*")
+
+
+def _hyperscan_agrees(pattern: bytes) -> bool:
+    """
+    Whether hyperscan matches pattern exactly where re does.
+    """
+    return _HYPERSCAN_SAFE.fullmatch(pattern) is not None
+
+
+def _conditions(cond: Condition) -> Iterator[Condition]:
+    yield cond
+    if isinstance(cond, (ast.AndCondition, ast.OrCondition)):
+        for child in cond.children:
+            yield from _conditions(child)
+    elif isinstance(cond, ast.NotCondition):
+        yield from _conditions(cond.child)
+
+
+def grep_patterns(commands: Iterable[Command]) -> list[bytes]:
+    """
+    The constant patterns of every whole-file grep in commands.
+    """
+    patterns: dict[bytes, None] = {}
+    for cmd in commands:
+        if not isinstance(cmd, ast.ConditionCommand):
+            continue
+        for cond in _conditions(cmd.condition):
+            if (
+                isinstance(cond, ast.GrepCondition)
+                and cond._compiled is not None
+                and cond.from_offset is None
+                and cond.to_offset is None
+            ):
+                patterns[cond._compiled.pattern] = None
+    return list(patterns)
+
+
+class GrepDatabase:
+    """
+    Every constant whole-file grep pattern of a rule set, compiled into one
+    hyperscan database so a file is searched for all of them in a single pass.
+
+    Only patterns in the syntax both hyperscan and re read the same way go to
+    hyperscan. Without it (or if it rejects a pattern), the patterns that are
+    fixed strings go into an Aho-Corasick automaton instead, when
+    pyahocorasick is installed and there are enough of them to pay for it.
+    Patterns covered by neither are left to search on their own.
+    """
+
+    # Fewest fixed strings for which one Aho-Corasick pass beats searching the
+    # file for each. Each absent string costs a full, but very fast, re scan;
+    # the automaton returns to Python for every occurrence of every string.
+    # On a 20 MB text file the two broke even between 8 and 32 strings.
+    AHOCORASICK_MIN = 16
+
+    # How much of the file to decode for the automaton at a time.
+    SCAN_CHUNK = 1 << 20
+
+    def __init__(self, patterns: Iterable[bytes]):
+        self._ids = {p: i for i, p in enumerate(patterns)}
+        self._patterns = list(self._ids)
+        self._db = None
+        self._automaton = None
+        self._longest = 0
+        self._covered: frozenset[bytes] = frozenset()
+        if not self._ids:
+            return
+        if hyperscan is not None:
+            agreed = [p for p in self._patterns if _hyperscan_agrees(p)]
+            if agreed:
+                self._db = self._compile_hyperscan(agreed)
+            if self._db is not None:
+                self._patterns = agreed
+                self._covered = frozenset(agreed)
+                return
+        if ahocorasick is not None:
+            literals = [
+                p
+                for p in self._patterns
+                if p and not ast._REGEX_SYNTAX.intersection(p.decode())
+            ]
+            if len(literals) >= self.AHOCORASICK_MIN:
+                automaton = ahocorasick.Automaton()
+                for p in literals:
+                    # Latin-1 maps bytes one to one onto code points.
+                    automaton.add_word(p.decode("latin-1"), p)
+                automaton.make_automaton()
+                self._automaton = automaton
+                self._longest = max(map(len, literals))
+                self._covered = frozenset(literals)
+
+    @staticmethod
+    def _compile_hyperscan(patterns: list[bytes]):
+        flags = hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_MULTILINE
+        # re.search finds empty matches, so hyperscan must too.
+        flags |= hyperscan.HS_FLAG_ALLOWEMPTY
+        db = hyperscan.Database()
+        try:
+            db.compile(
+                expressions=patterns,
+                ids=list(range(len(patterns))),
+                flags=[flags] * len(patterns),
+            )
+        except hyperscan.error as e:
+            logger.info("Not batching greps with hyperscan: %s", e)
+            return None
+        return db
+
+    @classmethod
+    def for_commands(cls, commands: Iterable[Command]) -> "GrepDatabase":
+        return cls(grep_patterns(commands))
+
+    def covers(self, pattern: bytes) -> bool:
+        return pattern in self._covered
+
+    def scan(self, buf: bytes) -> frozenset[bytes]:
+        """
+        The covered patterns that match somewhere in buf.
+        """
+        if self._db is not None:
+            hits: set[int] = set()
+
+            def on_match(id: int, start: int, end: int, flags: int, context) -> None:
+                hits.add(id)
+
+            self._db.scan(buf, match_event_handler=on_match)
+            return frozenset(self._patterns[i] for i in hits)
+
+        assert self._automaton is not None
+        found: set[bytes] = set()
+        # A chunk at a time, so a big mapped file isn't copied whole. Chunks
+        # overlap enough that no match straddles a boundary unseen.
+        overlap = self._longest - 1
+        for start in range(0, len(buf), self.SCAN_CHUNK):
+            text = str(buf[start : start + self.SCAN_CHUNK + overlap], "latin-1")
+            for _, p in self._automaton.iter(text):
+                found.add(p)
+                if len(found) == len(self._covered):
+                    return frozenset(found)
+        return frozenset(found)
+
+
+def _search_file(path: Path, patterns: list[bytes]) -> frozenset[bytes] | None:
+    """
+    The patterns that match somewhere in the file at path, or None if it
+    can't be read. Runs in prescan's worker processes.
+    """
+    try:
+        with open(path, "rb") as fh:
+            try:
+                buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                buf = fh.read()
+    except OSError:
+        return None
+    try:
+        return frozenset(p for p in patterns if ast._compile_grep(p).search(buf))
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def prescan(
+    paths: list[Path], patterns: list[bytes], jobs: int
+) -> dict[Path, frozenset[bytes]]:
+    """
+    Search every path for every pattern, spread over jobs processes.
+
+    Paths that can't be read (directories, missing files, ...) are left out,
+    so greps of them go through the usual path and fail the usual way.
+    """
+    if not paths or not patterns:
+        return {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        chunksize = max(1, len(paths) // (jobs * 4))
+        found = pool.map(
+            _search_file, paths, [patterns] * len(paths), chunksize=chunksize
+        )
+        return {p: hits for p, hits in zip(paths, found) if hits is not None}
@@ -1,9 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
+import os
 
+from .util import optstr
 
-@dataclass
+
+@dataclass(slots=True)
 class Routable:
     # identifier for source of message
     src: str
@@ -21,10 +24,29 @@ class Routable:
 
     attr: dict[str, str]
 
+    # data as a string, as conditions and actions consume it. Kept in step
+    # with data by World.set_var.
+    data_str: str | None = field(init=False, default=None, repr=False, compare=False)
+
+    # The path filetype conditions stat, once resolved. Reset whenever a
+    # variable is set, since data, wdir and file all feed into it.
+    resolved_path: str | None = field(
+        init=False, default=None, repr=False, compare=False
+    )
+
+    # stat() results for paths looked up while routing this message.
+    stat_cache: dict[str, os.stat_result | None] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        self.data_str = optstr(self.data)
+
     @property
     def ndata(self):
         if not self.data:
             return 0
-        if isinstance(self.data, Path):
-            return len(str(self.data))
-        return len(self.data)
+        if isinstance(self.data, bytes):
+            return len(self.data)
+        # Paths are measured by their string form, which data_str already is.
+        return len(self.data_str)
@@ -1,9 +1,12 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+import mmap
+import re
 import shlex
 import os.path
-from typing import TypeVar, TYPE_CHECKING, Iterable, Self
-from typing import Generator
+import sys
+from typing import Any, TypeVar, TYPE_CHECKING, Iterable, Self
 from pathlib import Path
 from subprocess import run
 
@@ -13,11 +16,33 @@ from . import aast
 
 if TYPE_CHECKING:
     import ast
+    from .index import RuleIndex
+    from .multigrep import GrepDatabase
 
 T = TypeVar("T")
 
+# Marks a missing cache entry where None is a cached value.
+_UNCACHED: Any = object()
 
-@dataclass
+# Variables that are fields of the routed object. Most lookups are of other
+# names, which this lets skip the field dispatch.
+_OBJ_VARS = frozenset({"attr", "data", "dst", "type", "src", "wdir"})
+
+
+def _ssh_host(dest: str) -> str | None:
+    """
+    The [user@]host of an rsync destination reached over ssh, or None for a
+    local path or an rsync daemon.
+    """
+    if "::" in dest or dest.startswith("rsync://"):
+        return None
+    host, sep, _ = dest.partition(":")
+    if not sep or not host or "/" in host:
+        return None
+    return host
+
+
+@dataclass(slots=True)
 class Op:
     type: str
     args: list[str]
@@ -27,71 +52,218 @@ class Op:
     provides_names: list[str] = field(default_factory=list)
     provides_op: list[Self] = field(default_factory=list)
 
-    ready_: bool = False
+    # How many of requires_op haven't executed yet.
+    pending_deps: int = 0
     executed: bool = False
 
+    # NUL separated file names to feed a shell command on stdin.
+    stdin: bytes | None = None
+    # Where an rsync or mv puts its sources.
+    dest: str | None = None
+
     def ready(self) -> bool:
-        if self.ready_:
-            return True
-        self.ready_ = all(op.executed for op in self.requires_op)
-        return self.ready_
+        return self.pending_deps == 0
+
+    def finish(self) -> list[Self]:
+        """
+        Mark the op executed, which the ops waiting on it count down. Returns
+        the ones that leaves ready.
+        """
+        self.executed = True
+        ready = []
+        for op in self.provides_op:
+            op.pending_deps -= 1
+            if op.pending_deps == 0:
+                ready.append(op)
+        return ready
+
+    def shell(self) -> str:
+        """
+        The command as it would be typed into a shell.
+        """
+        if self.stdin is None:
+            return shlex.join(self.args)
+        names = [os.fsdecode(n) for n in self.stdin.split(b"\0")]
+        return f"printf '%s\\0' {shlex.join(names)} | {shlex.join(self.args)}"
+
+
+def _show(command: str) -> None:
+    """
+    Print a command. File names the terminal's encoding can't represent are
+    written as their original bytes rather than failing.
+    """
+    try:
+        print(command)
+    except UnicodeEncodeError:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(os.fsencode(command) + b"\n")
+        sys.stdout.flush()
+
+
+def _ancestors(path: str) -> Iterable[str]:
+    while (parent := os.path.dirname(path)) != path:
+        yield parent
+        path = parent
+
+
+def _independent(ops: list[Op]) -> list[list[Op]]:
+    """
+    Split shell ops into groups that can run at the same time as each other.
+    Ops whose paths (sources or destination) overlap, by being the same path
+    or one inside the other, go in one group, in their order.
+    """
+    parent = list(range(len(ops)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = i = parent[parent[i]]
+        return i
+
+    def union(i: int, j: int) -> None:
+        parent[find(i)] = find(j)
+
+    # An op using each path, and the ops using something inside each path.
+    # The ops using one path are all grouped, so one stands for the rest.
+    at: dict[str, int] = {}
+    inside: defaultdict[str, list[int]] = defaultdict(list)
+    for i, op in enumerate(ops):
+        paths = list(op.requires_names)
+        if op.dest is not None:
+            paths.append(op.dest)
+        for path in map(os.path.abspath, paths):
+            union(i, at.setdefault(path, i))
+            for j in inside.get(path, ()):
+                union(i, j)
+            for ancestor in _ancestors(path):
+                if (j := at.get(ancestor)) is not None:
+                    union(i, j)
+                inside[ancestor].append(i)
+
+    groups: defaultdict[int, list[Op]] = defaultdict(list)
+    for i, op in enumerate(ops):
+        groups[find(i)].append(op)
+    return list(groups.values())
 
 
 class World:
+    # Past this many sources, rsync reads its file list from stdin rather than
+    # the command line, so huge batches stay one invocation under ARG_MAX.
+    RSYNC_FILES_FROM_MIN = 64
+
+    # For rsyncs to several destinations on one host: the first opens an ssh
+    # connection that the rest reuse instead of each logging in again.
+    RSYNC_SHARED_SSH = (
+        "ssh -o ControlMaster=auto -o ControlPath=~/.ssh/plumb-%r@%h:%p"
+        " -o ControlPersist=60"
+    )
+
     def add_rsync(self, dst: str, srcs: list[str]) -> Op:
-        self.rsync[dst].append(op := Op("rsync", list(srcs)))
+        op = Op("rsync", list(srcs), dest=dst)
         op.requires_names = list(srcs)
         if dst.endswith(os.path.sep):
-            op.provides_names = [str(Path(dst).joinpath(Path(s).name)) for s in srcs]
+            # Plain string joins: these names are only compared with the
+            # sources of later ops, which are data strings as given.
+            op.provides_names = [
+                os.path.join(dst, os.path.basename(s.rstrip(os.path.sep))) for s in srcs
+            ]
         else:
             op.provides_names = [dst]
         self.add_op(op)
         return op
 
     def add_move(self, dst: str, src: str) -> Op:
-        self.move_files[dst].append(op := Op("mv", [src]))
+        op = Op("mv", [src], dest=dst)
         op.requires_names = [src]
         self.add_op(op)
         return op
 
-    def add_shell(self, reqs: list[str], cmd: list[str]) -> Op:
-        self.shell_commands.append(op := Op("shell", list(cmd)))
+    def add_shell(
+        self, reqs: list[str], cmd: list[str], stdin: bytes | None = None
+    ) -> Op:
+        self.shell_commands.append(op := Op("shell", list(cmd), stdin=stdin))
         op.requires_names = list(reqs)
         self.add_op(op)
         return op
 
     def add_op(self, newop: Op) -> None:
-        for op in self.ops:
-            # todo: index ops by names rather than this ... O(N^3)-ish approach
-            if any(a == b for a in newop.provides_names for b in op.requires_names):
-                if newop is not op:
-                    newop.requires_op.append(op)
-                    op.provides.append(self)
+        # An op that writes a name waits for the ops before it that read it.
+        readers = {
+            id(op): op
+            for name in newop.provides_names
+            for op in self.readers.get(name, ())
+        }
+        for op in readers.values():
+            newop.requires_op.append(op)
+            op.provides_op.append(newop)
+            if not op.executed:
+                newop.pending_deps += 1
+        for name in newop.requires_names:
+            self.readers[name].append(newop)
         self.ops.append(newop)
-        self.pending_ops.append(newop)
+        self.pending_ops[id(newop)] = newop
+        if newop.ready():
+            self._enqueue(newop)
+
+    def _enqueue(self, op: Op) -> None:
+        """
+        Queue a ready op for run: rsyncs and moves by destination, for the
+        next pass to consolidate, and shell commands in order.
+        """
+        match op.type:
+            case "rsync":
+                self.ready_rsync[op.dest].append(op)
+            case "mv":
+                self.ready_moves[op.dest].append(op)
+            case "shell":
+                self.ready_shell.append(op)
+
+    def _finish(self, op: Op, executed_ops: list[Op]) -> None:
+        executed_ops.append(op)
+        for ready in op.finish():
+            self._enqueue(ready)
 
     def __init__(self):
         self.dry_run = True
-        self._stat_cache: dict[str, os.stat_result] = {}
+        # How many shell commands may run at once.
+        self.jobs = 1
+        # Hand fixed-string greps to grep(1) rather than searching in Python.
+        self.external_grep = False
         self.mode = aast.CommandResult.NEXT_COMMAND
 
         self.vars = {}
+        # $attr as text, for the current object's attr. None until needed
+        # after attr is set.
+        self._attr_str: str | None = None
         self.obj: Routable | None = None
 
         self.ops = []
-        self.pending_ops = []
-
-        self.rsync: defaultdict[str, list[Op]] = defaultdict(list)
-        self.move_files: defaultdict[str, list[Op]] = defaultdict(list)
+        # By id: Ops compare by value, so equal ops are still separate work.
+        self.pending_ops: dict[int, Op] = {}
+        # The ops that require each name.
+        self.readers: defaultdict[str, list[Op]] = defaultdict(list)
+
+        # The rsyncs and moves that are ready and not yet run, by destination.
+        self.ready_rsync: defaultdict[str, list[Op]] = defaultdict(list)
+        self.ready_moves: defaultdict[str, list[Op]] = defaultdict(list)
+        self.ready_shell: list[Op] = []
+
+        # The last commands routed, and where each one's next rule starts.
+        self._rule_jumps: tuple[tuple[aast.Command, ...], list[int]] | None = None
         self.shell_commands: list[Op] = []
 
-        import weakref, io
-        from . import ast
-
-        self.greps: weakref.WeakKeyDictionary[
-            "ast.GrepCondition", dict[Path, bool]
-        ] = weakref.WeakKeyDictionary({g: {} for g in ast.greps})
-        self.reads: dict[Path, tuple[io.IOBase, Generator[bool, bytes, None]]] = {}
+        # grep results by (pattern, from offset, to offset), then by file.
+        self.greps: dict[
+            tuple[re.Pattern, int | None, int | None], dict[Path, bool]
+        ] = {}
+        self.reads: dict[Path, mmap.mmap | bytes] = {}
+        # Every constant grep in the rules, for searching each file once.
+        self.grep_db: "GrepDatabase | None" = None
+        # Patterns from grep_db found in each file.
+        self.scans: dict[Path, frozenset[bytes]] = {}
+        # Patterns found in each file by a multigrep.prescan of the whole
+        # batch, before routing. Unlike scans, kept across objects.
+        self.prescanned: frozenset[bytes] = frozenset()
+        self.prescans: dict[Path, frozenset[bytes]] = {}
 
     def run(self):
         # Consolidate rsync/copies to the same destination
@@ -99,75 +271,163 @@ class World:
             executed_ops = list()
 
             # Translate ready rsyncs into shell commands
-            for dest, srcs in self.rsync.items():
-                goable = [s for s in srcs if s.ready() and not s.executed]
-                args = [x for s in goable for x in s.args]
-                cmd = ["rsync", "-vaP", *args, dest]
+            ready, self.ready_rsync = self.ready_rsync, defaultdict(list)
+            hosts = Counter(_ssh_host(dest) for dest in ready)
+            for dest, goable in ready.items():
+                # The same file routed twice only needs sending once.
+                args = list(dict.fromkeys(x for s in goable for x in s.args))
+                cmd = ["rsync", "-vaP"]
+                host = _ssh_host(dest)
+                if (
+                    host is not None
+                    and hosts[host] > 1
+                    and "RSYNC_RSH" not in os.environ
+                ):
+                    cmd += ["-e", self.RSYNC_SHARED_SSH]
+                # A trailing slash means "the directory's contents" on the
+                # command line, but a --files-from list has no such syntax, so
+                # those sources always stay in argv.
+                listed = [a for a in args if not a.endswith(os.sep)]
+                if len(listed) < self.RSYNC_FILES_FROM_MIN:
+                    listed = []
+                argv = [a for a in args if a.endswith(os.sep) or not listed]
                 for s in goable:
-                    s.executed = True
-                    executed_ops.append(s)
-                self.add_shell(reqs=args, cmd=cmd)
+                    self._finish(s, executed_ops)
+                if listed:
+                    # --files-from turns off -r and turns on -R. Undo both to
+                    # match the plain invocation. NUL separated as bytes, so
+                    # names with newlines or undecodable bytes go through.
+                    files_from = ["-r", "--no-relative", "--from0", "--files-from=-"]
+                    stdin = b"\0".join(os.fsencode(os.path.abspath(a)) for a in listed)
+                    self.add_shell(
+                        reqs=listed, cmd=[*cmd, *files_from, "/", dest], stdin=stdin
+                    ).dest = dest
+                if argv:
+                    self.add_shell(reqs=argv, cmd=[*cmd, *argv, dest]).dest = dest
 
             # Translate ready moves into shell commands
-            for dest, srcs in self.move_files.items():
-                goable = [s for s in srcs if s.ready() and not s.executed]
-                args = [x for s in goable for x in s.args]
+            ready, self.ready_moves = self.ready_moves, defaultdict(list)
+            for dest, goable in ready.items():
+                # mv fails outright if a source is repeated.
+                args = list(dict.fromkeys(x for s in goable for x in s.args))
                 cmd = ["mv", *args, dest]
                 for s in goable:
-                    s.executed = True
-                    executed_ops.append(s)
-                self.add_shell(reqs=args, cmd=cmd)
+                    self._finish(s, executed_ops)
+                self.add_shell(reqs=args, cmd=cmd).dest = dest
 
             # Run the accumulated external commands
+            cmds, self.ready_shell = self.ready_shell, []
             if self.dry_run:
-                for cmd in self.shell_commands:
-                    if not cmd.ready() or cmd.executed:
-                        continue
-                    print(shlex.join(cmd.args))
-                    cmd.executed = True
-                    executed_ops.append(cmd)
+                for cmd in cmds:
+                    _show(cmd.shell())
+                    self._finish(cmd, executed_ops)
             else:
-                for cmd in self.shell_commands:
-                    if not cmd.ready():
-                        continue
-                    cmd.executed = True
-                    executed_ops.append(cmd)
-                    print(shlex.join(cmd.args))
-                    run(cmd.args)
+                for cmd in cmds:
+                    self._finish(cmd, executed_ops)
+                if self.jobs > 1 and len(cmds) > 1:
+                    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                        list(pool.map(self._run_shell, _independent(cmds)))
+                else:
+                    self._run_shell(cmds)
+
+            if not executed_ops:
+                # Ops only ever wait on ops added before them, so something
+                # is always ready. Don't spin forever if that breaks.
+                raise RuntimeError(f"No op can run: {list(self.pending_ops.values())}")
 
             trace = self.var("debugtrace", False)
             for o in reversed(executed_ops):
                 if trace:
                     print("DONE", o)
-                self.pending_ops.remove(o)
+                del self.pending_ops[id(o)]
+
+    @staticmethod
+    def _run_shell(cmds: list[Op]) -> None:
+        for cmd in cmds:
+            _show(cmd.shell())
+            run(cmd.args, input=cmd.stdin)
 
     def stat_path(self, path: str | bytes | Path | None) -> os.stat_result | None:
-        if path is None:
+        """
+        stat() path, at most once per routed object.
+        """
+        p = optstr(path)
+        if p is None:
             return None
-        assert path is not None
-        if path not in self._stat_cache:
-            p = optstr(path)
-            if p is not None:
+        cache = self.obj.stat_cache if self.obj is not None else {}
+        st = cache.get(p, _UNCACHED)
+        if st is _UNCACHED:
+            try:
+                st = os.stat(p)
+            except OSError:
+                st = None
+            cache[p] = st
+        return st
+
+    def read_file(self, path: Path) -> mmap.mmap | bytes:
+        """
+        The contents of path, memory mapped where possible. Kept open until
+        the next object is routed so every grep of the file shares one read.
+        """
+        if (buf := self.reads.get(path)) is None:
+            with open(path, "rb") as fh:
                 try:
-                    self._stat_cache[p] = Path(p).stat()
-                except FileNotFoundError:
-                    self._stat_cache[optstr(path)] = None
-        return self._stat_cache[optstr(path)]
+                    buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        # Greps scan front to back. Read ahead aggressively.
+                        buf.madvise(mmap.MADV_SEQUENTIAL)
+                except (ValueError, OSError):
+                    # Empty or unmappable (e.g. a pipe). Fall back to reading it.
+                    buf = fh.read()
+            self.reads[path] = buf
+            if self.var("debugtrace", False):
+                print("OPEN", path)
+        return buf
+
+    def scan_file(self, pattern: bytes, path: Path) -> bool | None:
+        """
+        Whether pattern matches in path, from one grep_db scan of the file
+        for every pattern at once. None if grep_db doesn't have pattern.
+        """
+        if pattern in self.prescanned:
+            if (hits := self.prescans.get(path)) is not None:
+                return pattern in hits
+        if self.grep_db is None or not self.grep_db.covers(pattern):
+            return None
+        if (hits := self.scans.get(path)) is None:
+            hits = self.scans[path] = self.grep_db.scan(self.read_file(path))
+        return pattern in hits
+
+    def grep_file(self, literal: bytes, path: Path) -> bool | None:
+        """
+        Whether path contains literal, according to grep(1). None if grep
+        couldn't tell us.
+        """
+        try:
+            proc = run(
+                ["grep", "-q", "-F", "-e", literal, "--", path],
+                env={**os.environ, "LC_ALL": "C"},
+            )
+        except OSError:
+            return None
+        if self.var("debugtrace", False):
+            print("GREP", path, proc.returncode)
+        return {0: True, 1: False}.get(proc.returncode)
 
     def next_obj(self, obj: Routable) -> None:
         # Reset any file reads and pre-computed greps. (files can change
         # between object routings, but are assumed to not change in the middle
         # of routing an object.)
-        for g in self.greps.keys():
-            self.greps[g] = {}
+        self.greps.clear()
+        self.scans.clear()
         while self.reads:
-            _, (fh, chk) = self.reads.popitem()
-            chk.close()
-            fh.close()
+            _, buf = self.reads.popitem()
+            if isinstance(buf, mmap.mmap):
+                buf.close()
 
         self.obj = obj
         self.init_obj_dir_vars()
-        self.vars["attr"] = ",".join(f"{k}={v}" for k, v in self.obj.attr.items())
+        self._attr_str = self.vars["attr"] = self._render_attr()
         self.vars["data"] = self.obj.data
         self.vars["dst"] = self.obj.dst
         self.vars["type"] = self.obj.type
@@ -177,40 +437,56 @@ class World:
     def init_obj_dir_vars(self):
         obj = self.obj
         assert obj
-        dat = optstr(obj.data)
+        dat = obj.data_str
         if obj.wdir is not None and dat is not None:
-            self.set_var("dir", str(obj.wdir.joinpath(dat).parent))
-            self.set_var("file", str(obj.wdir.joinpath(dat)))
+            path = obj.wdir.joinpath(dat)
+            # Neither is an object field, so set_var would only do this.
+            obj.resolved_path = None
+            self.vars["dir"] = str(path.parent)
+            self.vars["file"] = str(path)
 
     def set_var(self, key: str, value: str | None) -> None:
         assert self.obj
         strvalue = "" if value is None else value
-        match key:
-            case "attr":
-                self.obj.attr = {
-                    k: v for o in strvalue.split(",") for k, _, v in o.partition("=")
-                }
-            case "data":
-                self.obj.data = strvalue
-            case "dst":
-                self.obj.dst = strvalue
-            case "type":
-                self.obj.type = strvalue
-            case "src":
-                self.obj.src = strvalue
-            case "wdir":
-                if value:
-                    self.obj.wdir = Path(value)
-                    self.init_obj_dir_vars()
-                else:
-                    self.obj.wdir = None
+        self.obj.resolved_path = None
+        if key in _OBJ_VARS:
+            match key:
+                case "attr":
+                    self._attr_str = None
+                    self.obj.attr = {
+                        k: v
+                        for k, _, v in (o.partition("=") for o in strvalue.split(","))
+                    }
+                case "data":
+                    self.obj.data = strvalue
+                    self.obj.data_str = strvalue
+                case "dst":
+                    self.obj.dst = strvalue
+                case "type":
+                    self.obj.type = strvalue
+                case "src":
+                    self.obj.src = strvalue
+                case "wdir":
+                    if value:
+                        self.obj.wdir = Path(value)
+                        self.init_obj_dir_vars()
+                    else:
+                        self.obj.wdir = None
         self.vars[key] = value
 
+    def _render_attr(self) -> str:
+        assert self.obj
+        return ",".join(f"{k}={v}" for k, v in self.obj.attr.items())
+
     def var(self, key: str, default: str | T) -> str | bytes | Path | None | T:
         assert self.obj
+        if key not in _OBJ_VARS:
+            return self.vars.get(key, default)
         match key:
             case "attr":
-                return ",".join(f"{k}={v}" for k, v in self.obj.attr.items())
+                if self._attr_str is None:
+                    self._attr_str = self._render_attr()
+                return self._attr_str
             case "data":
                 return self.obj.data
             case "dst":
@@ -223,25 +499,67 @@ class World:
                 return self.obj.wdir
         return self.vars.get(key, default)
 
-    def route(self, commands: Iterable[aast.Command], value: Routable):
+    def route(
+        self,
+        commands: Iterable[aast.Command],
+        value: Routable,
+        index: "RuleIndex | None" = None,
+    ):
         from .ast import RuleCommand
 
-        self.mode = aast.CommandResult.NEXT_COMMAND
-        for cmd in commands:
-            trace = self.var("debugtrace", False)
-            match self.mode:
-                case aast.CommandResult.NEXT_COMMAND:
-                    if trace:
-                        print("RUN", cmd, end="  ")
-                    self.mode = cmd.run(self, value)
-                    if trace:
-                        print("->", self.mode)
-                case aast.CommandResult.NEXT_RULE:
-                    if isinstance(cmd, RuleCommand):
-                        if trace:
-                            print("RULE", cmd)
-                        self.mode = cmd.run(self, value)
-                case aast.CommandResult.STOP:
-                    if trace and isinstance(cmd, RuleCommand):
-                        print("STOP", cmd)
-                    break
+        NEXT_COMMAND = aast.CommandResult.NEXT_COMMAND
+        NEXT_RULE = aast.CommandResult.NEXT_RULE
+        STOP = aast.CommandResult.STOP
+        get_var = self.vars.get
+        may_match = index.may_match if index is not None else None
+
+        commands = tuple(commands)
+        next_rule = self._next_rules(commands)
+
+        mode = NEXT_COMMAND
+        pos = 0
+        while pos < len(commands):
+            cmd = commands[pos]
+            trace = get_var("debugtrace", False)
+            if mode is STOP:
+                if trace and isinstance(cmd, RuleCommand):
+                    print("STOP", cmd)
+                break
+            is_rule = isinstance(cmd, RuleCommand)
+            if is_rule and may_match is not None and not may_match(pos, value.data_str):
+                # The rule's opening glob can't match. Skip straight to the next rule.
+                if trace:
+                    print("SKIP", cmd)
+                mode = NEXT_RULE
+            elif mode is NEXT_COMMAND:
+                if trace:
+                    print("RUN", cmd, end="  ")
+                mode = cmd.run(self, value)
+                if trace:
+                    print("->", mode)
+            elif mode is NEXT_RULE and is_rule:
+                if trace:
+                    print("RULE", cmd)
+                mode = cmd.run(self, value)
+            # Nothing before the next rule runs once the current one fails.
+            pos = next_rule[pos] if mode is NEXT_RULE else pos + 1
+        self.mode = mode
+
+    def _next_rules(self, commands: tuple[aast.Command, ...]) -> list[int]:
+        """
+        For each position in commands, the position of the first rule
+        command after it, or len(commands). Kept for the last commands
+        routed, which are nearly always the next ones too.
+        """
+        from .ast import RuleCommand
+
+        if self._rule_jumps is not None and self._rule_jumps[0] is commands:
+            return self._rule_jumps[1]
+        next_rule = [len(commands)] * len(commands)
+        for pos in range(len(commands) - 2, -1, -1):
+            following = pos + 1
+            if not isinstance(commands[following], RuleCommand):
+                following = next_rule[following]
+            next_rule[pos] = following
+        self._rule_jumps = (commands, next_rule)
+        return next_rule
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from .routable import Routable
+from .world import Op, World, _independent
+
+
+def test_overwriting_op_waits_for_earlier_readers():
+    w = World()
+    move = w.add_move("/elsewhere", "/dest/a")
+    copy = w.add_rsync("/dest/", ["/src/a", "/src/b"])
+    assert copy.requires_op == [move]
+    assert move.provides_op == [copy]
+    assert not copy.ready()
+
+
+def test_op_is_ready_once_its_requirements_finish():
+    w = World()
+    move = w.add_move("/elsewhere", "/dest/a")
+    copy = w.add_rsync("/dest/", ["/src/a"])
+    move.finish()
+    assert copy.ready()
+
+
+def test_independent_shell_ops():
+    w = World()
+    copy_a = w.add_shell(["/src/a"], ["rsync", "/src/a", "/x/"])
+    copy_a.dest = "/x/"
+    move_a = w.add_shell(["/src/a"], ["mv", "/src/a", "/y"])
+    move_a.dest = "/y"
+    into_src = w.add_shell(["/z/c"], ["mv", "/z/c", "/src"])
+    into_src.dest = "/src"
+    other = w.add_shell(["/z/d"], ["mv", "/z/d", "/w"])
+    other.dest = "/w"
+    assert _independent([copy_a, move_a, into_src, other]) == [
+        [copy_a, move_a, into_src],
+        [other],
+    ]
+
+
+def test_shell_ops_on_overlapping_paths_are_not_independent():
+    w = World()
+    # The move's source is where the copy puts its file.
+    copy = w.add_rsync("/b/y", ["/a/x"])
+    move = w.add_move("/c", "/b/y")
+    # A source inside a directory that another op copies.
+    copy_dir = w.add_rsync("/d/", ["/e"])
+    move_inside = w.add_move("/f", "/e/g/h")
+    # A destination inside a directory that another op moves.
+    move_dir = w.add_move("/i", "/j")
+    copy_into = w.add_rsync("/j/k/", ["/l"])
+    assert copy.ready() and move.ready()
+    assert _independent([copy, move, copy_dir, move_inside, move_dir, copy_into]) == [
+        [copy, move],
+        [copy_dir, move_inside],
+        [move_dir, copy_into],
+    ]
+
+
+def test_run_fails_rather_than_spins_when_stuck():
+    w = World()
+    # Waiting on something that will never finish.
+    w.add_op(Op("mv", ["/dest/a"], dest="/elsewhere", pending_deps=1))
+    with pytest.raises(RuntimeError):
+        w.run()
+
+
+def test_set_attr():
+    w = World()
+    w.next_obj(Routable("", "", "x", "x", "text", None, {}))
+    assert w.var("attr", None) == ""
+    w.set_var("attr", "a=1,b")
+    assert w.obj.attr == {"a": "1", "b": ""}
+    assert w.var("attr", None) == "a=1,b="
+
+
+def test_rsync_file_list_keeps_odd_names(capsysbinary):
+    w = World()
+    w.next_obj(Routable("", "", "x", "x", "text", None, {}))
+    odd = [os.fsdecode(b"/src/caf\xe9"), "/src/new\nline"]
+    plain = [f"/src/{i}" for i in range(World.RSYNC_FILES_FROM_MIN)]
+    w.add_rsync("/dest/", odd + plain)
+    w.run()
+    (cmd,) = w.shell_commands
+    assert "--from0" in cmd.args
+    assert cmd.stdin.split(b"\0")[:2] == [b"/src/caf\xe9", b"/src/new\nline"]
+    assert b"'/src/caf\xe9'" in capsysbinary.readouterr().out
+
+
+def test_rsync_file_list_keeps_directory_contents_sources():
+    w = World()
+    w.next_obj(Routable("", "", "x", "x", "text", None, {}))
+    plain = [f"/src/{i}" for i in range(World.RSYNC_FILES_FROM_MIN)]
+    w.add_rsync("/dest/", plain + ["/src/dir/"])
+    w.run()
+    listed, argv = w.shell_commands
+    assert b"/src/dir" not in listed.stdin
+    assert argv.args == ["rsync", "-vaP", "/src/dir/", "/dest/"]
+    assert argv.stdin is None